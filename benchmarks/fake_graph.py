@@ -0,0 +1,252 @@
+'''Offline stand-in for the Microsoft Graph Sent Items endpoints
+
+A SyntheticMailbox of generated messages is served by a FakeGraphServer on
+a local port, with the paging, filters, sorting, throttling and attachment
+downloads used by crm_app.network.RetrieveSentDocuments. offline_session()
+connects the O365 package to the server in place of a MailSession:
+
+    mailbox = SyntheticMailbox(messages=10000, recipients=200)
+    with FakeGraphServer(mailbox, latency=0.02) as server:
+        sent_docs = RetrieveSentDocuments(offline_session(server))
+        sent_docs.get_all(mailbox.tenant_emails)
+'''
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+from O365 import Account, MSGraphProtocol
+
+
+class SyntheticMailbox():
+    '''Sent messages to tenants and other contacts, the same for the same arguments'''
+
+    # the first message is sent at start, each next one interval later
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    interval = timedelta(minutes=10)
+    # attachments are drawn from this many documents, so that some repeat
+    documents = 100
+
+    def __init__(self, messages=1000, recipients=100, attachments=2,
+                 attachment_size=20000, seed=0):
+        '''Constructor for SyntheticMailbox
+
+        arguments:
+            messages - number of messages
+            recipients - number of tenants, whose addresses are tenant_emails
+            attachments - most attachments of a message, a random number up to it
+            attachment_size - average size of the attachments in bytes
+            seed - seed of the random choices
+        '''
+        self.tenant_emails = [f'tenant{number}@example.com' for number in range(recipients)]
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.random = random.Random(seed)
+        # newest first, as the server lists them
+        self.messages = []
+        # attachment id: document number
+        self.contents = {}
+        self.add(messages)
+
+    def add(self, count):
+        '''Send count more messages, newer than the others'''
+
+        sent = [self.message(len(self.messages) + number) for number in range(count)]
+        self.messages[:0] = sent[::-1]
+
+    def message(self, number):
+        recipients = []
+        for _ in range(self.random.randint(1, 3)):
+            # half the recipients are tenants, with mixed case addresses
+            if self.random.random() < 0.5:
+                address = self.random.choice(self.tenant_emails).capitalize()
+            else:
+                address = f'contact{self.random.randrange(1000)}@example.org'
+            recipients.append({'emailAddress': {'name': address.split('@')[0].title(),
+                                                'address': address}})
+        attachments = []
+        for position in range(self.random.randint(0, self.attachments)):
+            document = self.random.randrange(self.documents)
+            attachment_id = f'a{number}-{position}'
+            self.contents[attachment_id] = document
+            attachments.append({'@odata.type': '#microsoft.graph.fileAttachment',
+                                'id': attachment_id, 'name': f'document{document}.pdf',
+                                'size': self.content_size(document),
+                                'contentType': 'application/pdf'})
+        sent = (self.start + number * self.interval).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {'id': f'm{number}', 'subject': f'Document {number}', 'sentDateTime': sent,
+                'toRecipients': recipients, 'hasAttachments': bool(attachments),
+                'attachments': attachments}
+
+    def content_size(self, document):
+        # between half and one and a half times the average size
+        return self.attachment_size // 2 + document * self.attachment_size // self.documents
+
+    def content(self, attachment_id):
+        '''Content of an attachment, the same for all copies of a document'''
+
+        document = self.contents[attachment_id]
+        block = hashlib.sha256(str(document).encode()).digest()
+        size = self.content_size(document)
+        return (block * (size // len(block) + 1))[:size]
+
+
+class FakeGraphServer():
+    '''HTTP server answering the Graph requests made by the email retrieval
+
+    Counts the requests, the throttled ones and the response bytes sent.
+    '''
+
+    messages_path = re.compile(r'/[^/]+/users/[^/]+/mailFolders/SentItems/messages$',
+                               re.IGNORECASE)
+    content_path = re.compile(r'/[^/]+/users/[^/]+/messages/([^/]+)/attachments/'
+                              r'([^/]+)/\$value$')
+    recipient_filter = re.compile(r"toRecipients/any\(r:r/emailAddress/address eq '(.*)'\)")
+    time_filter = re.compile(r'sentDateTime (ge|lt) (\S+)')
+
+    def __init__(self, mailbox, latency=0, throttle_every=0, retry_after=0):
+        '''Constructor for FakeGraphServer
+
+        arguments:
+            mailbox - SyntheticMailbox served
+            latency - seconds taken by every request
+            throttle_every - answer every so many requests with HTTP 429, 0 never
+            retry_after - seconds the throttled requests are told to wait
+        '''
+        self.mailbox = mailbox
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        # filtered and sorted message lists, by query
+        self.listings = {}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, as with the real server
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.respond(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, request):
+        with self.lock:
+            self.requests += 1
+            throttle = self.throttle_every and self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        time.sleep(self.latency)
+        url = urlsplit(request.path)
+        path = unquote(url.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if throttle:
+            self.send(request, 429, {'error': {'code': 'TooManyRequests'}},
+                      {'Retry-After': str(self.retry_after)})
+        elif self.messages_path.match(path):
+            self.send(request, 200, self.messages_page(url.path, params))
+        elif self.content_path.match(path):
+            attachment_id = self.content_path.match(path).group(2)
+            self.send(request, 200, self.mailbox.content(attachment_id))
+        else:
+            self.send(request, 404, {'error': {'code': 'ResourceNotFound'}})
+
+    def send(self, request, status, body, headers={}):
+        if isinstance(body, bytes):
+            content_type = 'application/octet-stream'
+        else:
+            body = json.dumps(body).encode()
+            content_type = 'application/json'
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+
+    def listing(self, filters, order_by):
+        '''Messages matching $filter, in $orderby order, cached for the next pages'''
+
+        # messages added since are seen by a new listing
+        key = (filters, order_by, len(self.mailbox.messages))
+        if key not in self.listings:
+            messages = self.mailbox.messages
+            recipient = self.recipient_filter.search(filters)
+            if recipient:
+                address = recipient.group(1).replace("''", "'").lower()
+                messages = [message for message in messages
+                            if any(to['emailAddress']['address'].lower() == address
+                                   for to in message['toRecipients'])]
+            for operator, value in self.time_filter.findall(filters):
+                # times are all formatted alike, so they compare as text
+                if operator == 'ge':
+                    messages = [message for message in messages if message['sentDateTime'] >= value]
+                else:
+                    messages = [message for message in messages if message['sentDateTime'] < value]
+            if order_by == 'sentDateTime asc':
+                messages = messages[::-1]
+            self.listings[key] = messages
+        return self.listings[key]
+
+    def messages_page(self, path, params):
+        messages = self.listing(params.get('$filter', ''), params.get('$orderby', ''))
+        top = min(int(params.get('$top', 10)), 999)
+        skip = int(params.get('$skip', 0))
+        page = {'value': messages[skip:skip + top]}
+        if skip + top < len(messages):
+            page['@odata.nextLink'] = (self.url.rstrip('/') + path + '?'
+                                       + urlencode(dict(params, **{'$skip': skip + top})))
+        return page
+
+
+class LocalGraphProtocol(MSGraphProtocol):
+    '''Graph protocol addressing the given URL in place of Microsoft's'''
+
+    def __init__(self, url, **kwargs):
+        self._protocol_url = url
+        super().__init__(**kwargs)
+
+
+def offline_session(server, account_email='landlord@example.com', **kwargs):
+    '''Stand-in for network.MailSession reaching the fake server without signing in
+
+    Extra keyword arguments go to the O365 connection, such as requests_delay.
+    '''
+
+    protocol = LocalGraphProtocol(server.url, api_version='beta')
+    account = Account(('offline', 'offline'), protocol=protocol, **kwargs)
+    # requests carry a placeholder token instead of a signed-in one
+    account.con.session = account.con.get_naive_session()
+    account.con.session.headers['Authorization'] = 'Bearer offline'
+    mailbox = account.mailbox(resource=account_email)
+    return SimpleNamespace(account_email=account_email, account=account, mailbox=mailbox,
+                           sent_folder=mailbox.sent_folder())
@@ -0,0 +1,42 @@
+'''Time taken to import the application modules in a fresh interpreter
+
+usage, from the application root directory:
+    python -m benchmarks.import_time --repeats 20
+
+Each import runs in its own Python process so that nothing is cached in
+sys.modules; the dependencies are timed on their own for comparison.
+'''
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+modules = ['psycopg2', 'psycopg2.extras', 'psycopg2.pool', 'crm_app.models']
+
+timer = ('import time; start = time.perf_counter(); import {module}; '
+         'print(time.perf_counter() - start)')
+
+
+def import_time(module):
+    '''Seconds taken by the import of module in a new interpreter'''
+
+    result = subprocess.run([sys.executable, '-c', timer.format(module=module)],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('modules', nargs='*', default=modules)
+    args = parser.parse_args()
+
+    print(f'{"module":<30}{"median ms":>12}{"max ms":>12}')
+    for module in args.modules:
+        times = [1000 * import_time(module) for _ in range(args.repeats)]
+        print(f'{module:<30}{statistics.median(times):>12.2f}{max(times):>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+'''Lookup query times with and without the lookup indexes of migrations 001 and 002
+
+usage, from the application root directory:
+    python -m benchmarks.indexes --user crm --password secret --sizes 10000 100000 1000000
+
+The benchmark drops and recreates all tables in the given database, which
+should be a scratch database rather than housing_management.
+'''
+
+import argparse
+import random
+import statistics
+import time
+from crm_app.models import SQLModel
+
+# indexes on the lookup columns, dropped to time the queries without them
+lookup_indexes = ['tenants_prop_id_key', 'properties_ll_id_idx', 'properties_street_idx',
+                  'documents_recipient_date_sent_key']
+
+drop_command = ('DROP TABLE IF EXISTS schema_version, mail_sync_state, document_attachments, '
+                'documents, tenants, properties, landlords, landlord_stats, building_stats '
+                'CASCADE')
+
+# one landlord per 100 properties, one vacant property in five and as
+# many documents as properties; identifiers are hexadecimal to fit the
+# column sizes up to 16 million properties
+fill_commands = [
+    ('INSERT INTO landlords SELECT \'L\' || to_hex(n) '
+     'FROM generate_series(1, GREATEST(%(size)s / 100, 1)) AS n'),
+    ('INSERT INTO properties SELECT \'P\' || to_hex(n), '
+     '\'L\' || to_hex(1 + n %% GREATEST(%(size)s / 100, 1)), 10, n %% 1000, '
+     '\'Street \' || (n / 10), \'NW1\', \'London\' FROM generate_series(1, %(size)s) AS n'),
+    ('INSERT INTO tenants SELECT \'P\' || to_hex(n), \'First\', \'Last\' || n, '
+     '\'t\' || n || \'@example.com\' FROM generate_series(1, %(size)s) AS n WHERE n %% 5 <> 0'),
+    ('INSERT INTO documents (subject, recipient, date_sent, date_retrieved) '
+     'SELECT \'Subject \' || n, \'t\' || (CASE WHEN k %% 5 = 0 THEN k - 1 ELSE k END) '
+     '|| \'@example.com\', TIMESTAMP \'2020-01-01\' + n * INTERVAL \'1 minute\', '
+     'CURRENT_TIMESTAMP(0) '
+     'FROM (SELECT n, 1 + (n::BIGINT * 7919) %% %(size)s AS k '
+     'FROM generate_series(1, %(size)s) AS n) AS numbers'),
+    # one document in three has an attachment
+    ('INSERT INTO document_attachments (doc_id, position, name) '
+     'SELECT doc_id, 1, \'lease.pdf\' FROM documents WHERE doc_id %% 3 = 0'),
+    'ANALYZE',
+]
+
+
+def tenant_number(size):
+    number = random.randint(1, size)
+    return number - 1 if number % 5 == 0 else number
+
+
+def lookups(model, size):
+    '''Lookups made by the application, each taking random keys'''
+
+    return {
+        'record by Property ID':
+            lambda: model.get_record(f'P{random.randint(1, size):x}'),
+        'records by landlord':
+            lambda: model.get_records_page(
+                filters={'Landlord ID': f'L{random.randint(1, max(size // 100, 1)):x}'}),
+        'documents by recipient':
+            lambda: model.get_documents_by_email(f't{tenant_number(size)}@example.com', False),
+        'documents with attachments by recipient':
+            lambda: model.get_documents_by_email(f't{tenant_number(size)}@example.com', True),
+    }
+
+
+def time_lookups(model, size, repeats):
+    '''Median time of each lookup in milliseconds'''
+
+    results = {}
+    for name, lookup in lookups(model, size).items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            lookup()
+            times.append(1000 * (time.perf_counter() - start))
+        results[name] = statistics.median(times)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='crm_benchmark')
+    parser.add_argument('--user', default='crm')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    model = SQLModel(args.host, args.database, args.user, args.password)
+    print(f'{"properties":>10}  {"lookup":<40}{"indexed ms":>12}{"no index ms":>12}')
+    for size in args.sizes:
+        model.query(drop_command)
+        model.create_db_and_tables()
+        for command in fill_commands:
+            model.query(command, {'size': size})
+        indexed = time_lookups(model, size, args.repeats)
+        for index in lookup_indexes:
+            model.query(f'DROP INDEX {index}')
+        model.query('ANALYZE')
+        unindexed = time_lookups(model, size, args.repeats)
+        for name in indexed:
+            print(f'{size:>10}  {name:<40}{indexed[name]:>12.2f}{unindexed[name]:>12.2f}')
+    model.query(drop_command)
+    model.close()
+
+
+if __name__ == '__main__':
+    main()
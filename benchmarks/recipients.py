@@ -0,0 +1,82 @@
+'''Cost per message of finding the recipients of sent emails
+
+usage, from the application root directory:
+    python -m benchmarks.recipients --messages 100000
+
+Messages of a synthetic mailbox, with the recipient objects of the O365
+package, are matched against the tenants as by the email retrieval; the
+parser used until the addresses were read from the recipient objects is
+timed for comparison, as is the fallback for recipients given as text.
+'''
+
+import argparse
+import random
+import re
+import time
+from types import SimpleNamespace
+from O365.utils import Recipient, Recipients
+from crm_app.network import recipient_address
+
+
+def synthetic_mailbox(messages, tenants):
+    '''Messages to one to three recipients, half of them tenants'''
+
+    random.seed(0)
+    mailbox = []
+    for number in range(messages):
+        recipients = []
+        for _ in range(random.randint(1, 3)):
+            if random.random() < 0.5:
+                address = f'Tenant{random.randrange(tenants)}@example.com'
+            else:
+                address = f'contact{random.randrange(10 * tenants)}@example.org'
+            recipients.append(Recipient(address=address, name=f'Contact {number}'))
+        mailbox.append(SimpleNamespace(to=Recipients(recipients)))
+    return mailbox
+
+
+def text_parser():
+    '''Matching of the recipient text, compiled on each retrieval'''
+
+    name_str = r'[a-zA-Z\s]+'
+    email_str = r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
+    complete_str = '('+name_str+'|'+email_str+')\\s\\(('+email_str+')\\)'
+    pattern = re.compile(complete_str)
+    return lambda recipient: pattern.sub(r'\2', str(recipient)).lower()
+
+
+def matched(mailbox, tenants, address):
+    count = 0
+    for message in mailbox:
+        for recipient in message.to:
+            if tenants.get(address(recipient)) is not None:
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--tenants', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    mailbox = synthetic_mailbox(args.messages, args.tenants)
+    tenants = {f'tenant{number}@example.com': f'Tenant{number}@example.com'
+               for number in range(args.tenants)}
+
+    print(f'{"parser":<20}{"matched":>10}{"us/message":>14}')
+    parsers = [('recipient text', None), ('address field', recipient_address),
+               ('text fallback', lambda recipient: recipient_address(str(recipient)))]
+    for name, address in parsers:
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            # the text parser was compiled once per retrieval
+            count = matched(mailbox, tenants, address or text_parser())
+            times.append(time.perf_counter() - start)
+        print(f'{name:<20}{count:>10}{1e6 * min(times) / args.messages:>14.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''Email retrieval throughput against an offline synthetic mailbox
+
+usage, from the application root directory:
+    python -m benchmarks.sync --user crm --password secret --messages 10000 --latency 0.1
+
+Each sync mode retrieves the emails of a benchmarks.fake_graph mailbox and
+saves them as the application does, reporting messages scanned per
+second, bytes downloaded from the server and database rows written. The
+benchmark drops and recreates all tables in the given database, which
+should be a scratch database rather than housing_management.
+'''
+
+import argparse
+import tempfile
+import time
+from benchmarks.fake_graph import FakeGraphServer, SyntheticMailbox, offline_session
+from benchmarks.indexes import drop_command
+from crm_app.models import AttachmentStore, SQLModel
+from crm_app.network import RetrieveSentDocuments
+
+# a property and tenant per mailbox recipient, tenant<n>@example.com
+fill_commands = [
+    'INSERT INTO landlords VALUES (\'L1\')',
+    ('INSERT INTO properties SELECT \'P\' || to_hex(n), \'L1\', 10, n %% 1000, '
+     '\'Street \' || (n / 10), \'NW1\', \'London\' FROM generate_series(0, %(size)s - 1) AS n'),
+    ('INSERT INTO tenants SELECT \'P\' || to_hex(n), \'First\', \'Last\' || n, '
+     '\'tenant\' || n || \'@example.com\' FROM generate_series(0, %(size)s - 1) AS n'),
+]
+
+reset_command = 'DELETE FROM documents; DELETE FROM mail_sync_state'
+
+# documents and attachment rows upserted by the open transaction, whose
+# documents all carry its start time
+rows_written_query = ('SELECT COUNT(*) + COALESCE(SUM(attachments), 0) AS rows FROM ('
+                      'SELECT (SELECT COUNT(*) FROM document_attachments AS da '
+                      'WHERE da.doc_id = dc.doc_id) AS attachments FROM documents AS dc '
+                      'WHERE date_retrieved = CURRENT_TIMESTAMP(0)) AS written')
+
+
+def sync(model, session, tenant_emails, concurrency, store=None):
+    '''Retrieve and save the emails to the tenants by RetrieveSentDocuments.sync'''
+
+    sent_docs = RetrieveSentDocuments(session, store=store, concurrency=concurrency)
+    start = time.perf_counter()
+    # the sync's own transaction is a savepoint of this one, whose start
+    # time the saved documents carry
+    with model.transaction():
+        sent_docs.sync(model, tenant_emails)
+        rows = model.query(rows_written_query)[0]['rows']
+    return {'scanned': sent_docs.scanned, 'matched': len(sent_docs.emails),
+            'seconds': time.perf_counter() - start, 'rows': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--database', default='crm_benchmark')
+    parser.add_argument('--user', default='crm')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--recipients', type=int, default=200)
+    parser.add_argument('--attachments', type=int, default=2,
+                        help='most attachments per message')
+    parser.add_argument('--attachment-size', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='seconds taken by every server request')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='answer every so many requests with HTTP 429')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests-delay', type=int, default=200,
+                        help='least milliseconds between requests, as set by O365')
+    args = parser.parse_args()
+
+    mailbox = SyntheticMailbox(messages=args.messages, recipients=args.recipients,
+                               attachments=args.attachments,
+                               attachment_size=args.attachment_size)
+    model = SQLModel(args.host, args.database, args.user, args.password)
+    model.query(drop_command)
+    model.create_db_and_tables()
+    for command in fill_commands:
+        model.query(command, {'size': args.recipients})
+
+    tenants = mailbox.tenant_emails
+    store_path = tempfile.TemporaryDirectory()
+    # name, recipients, concurrency, attachment store, new messages, kept from the previous sync
+    modes = [
+        ('full, sequential', tenants, 1, None, 0, False),
+        (f'full, {args.concurrency} requests', tenants, args.concurrency, None, 0, False),
+        ('incremental', tenants, args.concurrency, None, args.messages // 100, True),
+        ('one tenant', tenants[:1], args.concurrency, None, 0, False),
+        ('full, attachments', tenants, args.concurrency,
+         AttachmentStore(store_path.name), 0, False),
+    ]
+
+    print(f'{"mode":<22}{"scanned":>9}{"matched":>9}{"msg/s":>9}{"requests":>10}'
+          f'{"MB":>8}{"rows":>8}{"seconds":>9}')
+    with FakeGraphServer(mailbox, latency=args.latency,
+                         throttle_every=args.throttle_every) as server:
+        session = offline_session(server, requests_delay=args.requests_delay)
+        for name, recipients, concurrency, store, new, keep in modes:
+            if not keep:
+                model.query(reset_command)
+            mailbox.add(new)
+            requests, sent = server.requests, server.bytes_sent
+            result = sync(model, session, recipients, concurrency, store)
+            print(f'{name:<22}{result["scanned"]:>9}{result["matched"]:>9}'
+                  f'{result["scanned"] / result["seconds"]:>9.0f}'
+                  f'{server.requests - requests:>10}'
+                  f'{(server.bytes_sent - sent) / 1e6:>8.1f}{result["rows"]:>8}'
+                  f'{result["seconds"]:>9.2f}')
+    store_path.cleanup()
+    model.query(drop_command)
+    model.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,34 @@
-from crm_app.application import Application
+import time
+# before any other import, the start of --profile-startup timings
+profile_start = time.perf_counter()
 
-app = Application()
-app.mainloop()
+import argparse  # noqa: E402
+import getpass  # noqa: E402
+
+parser = argparse.ArgumentParser(description='Customer Relationship Management Application')
+parser.add_argument('--provision', action='store_true',
+                    help='create the database and its owner role if missing, then exit')
+parser.add_argument('--host', default='localhost', help='database server (--provision)')
+parser.add_argument('--database', default='housing_management',
+                    help='database created (--provision)')
+parser.add_argument('--user', default=getpass.getuser(),
+                    help='user allowed to create roles and databases (--provision)')
+parser.add_argument('--password', action='store_true',
+                    help='prompt for the password of --user (--provision)')
+parser.add_argument('--profile-startup', action='store_true',
+                    help='print the time taken to show the login dialog and, '
+                         'after login, to populate the record list')
+args = parser.parse_args()
+
+if args.provision:
+    from crm_app.models import SQLModel
+
+    password = getpass.getpass(f'Password for {args.user}: ') if args.password else None
+    created = SQLModel.provision(args.host, args.user, password, database=args.database)
+    print(', '.join(f'created {kind} {name}' for kind, name in created.items())
+          or 'nothing to do, role and database exist')
+else:
+    from crm_app.application import Application
+
+    app = Application(profile_start=profile_start if args.profile_startup else None)
+    app.mainloop()
@@ -1,5 +1,9 @@
 import platform
+import queue
+import threading
+import time
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
 from . import views as v
@@ -16,8 +20,15 @@ class Application(tk.Tk):
         'Windows': "~/AppData/Local/CRMApp",
     }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, profile_start=None, **kwargs):
+        '''Constructor for Application
+
+        arguments:
+            profile_start - time.perf_counter() value at process start; when
+                            given, startup times are printed, see profile()
+        '''
         super().__init__(*args, **kwargs)
+        self.profile_start = profile_start
 
         # application title
         self.title('CRM Application')
@@ -29,14 +40,22 @@ class Application(tk.Tk):
         self.inserted_rows = []
         self.updated_rows = []
 
+        # email retrieval runs on a worker thread, reporting progress through a queue
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.retrieval = None
+        self.retrieval_queue = queue.Queue()
+        self.retrieval_cancel = threading.Event()
+        # mail server session, opened by the first retrieval and then kept
+        self.mail_session = None
+
         # default name for filename
         datestring = datetime.today().strftime("%Y-%m-%d")
         default_filename = f'data_record_{datestring}.csv'
         self.filename = tk.StringVar(value=default_filename)
 
         # settings model and settings
-        config_dir = self.config_dirs.get(platform.system(), '~')
-        self.settings_model = m.SettingsModel(path=config_dir)
+        self.config_dir = self.config_dirs.get(platform.system(), '~')
+        self.settings_model = m.SettingsModel(path=self.config_dir)
         self.load_settings()
 
         # setting style
@@ -58,6 +77,7 @@ class Application(tk.Tk):
             'file->delete_property': self.open_delete_property_window,
             'file->import': self.on_file_import,
             'file->export': self.on_file_export,
+            'file->retrieve_all_emails': self.retrieve_all_emails,
             # method callbacks
             'on_update': self.on_update,
             'on_add_property': self.add_property,
@@ -65,6 +85,11 @@ class Application(tk.Tk):
             'on_open_record': self.open_record,
             'on_show_documents': self.show_documents,
             'on_retrieve_emails': self.retrieve_remote_emails,
+            'on_cancel_retrieval': self.cancel_retrieval,
+            'on_search_documents': self.search_documents,
+            'on_more_search_results': self.load_more_search_results,
+            'on_filter_records': self.populate_recordlist,
+            'on_more_records': self.load_more_records,
             'on_print_list': self.print_list,
             'on_show_number_of_properties_by_landlord': self.show_number_of_properties_by_landlord,
             'on_show_occupancy_in_properties': self.show_occupancy_in_properties,
@@ -74,7 +99,16 @@ class Application(tk.Tk):
         self.config(menu=menu)
 
         # create database and tables if non-existent
-        self.data_model.create_db_and_tables()
+        try:
+            self.data_model.create_db_and_tables()
+        except m.pg.Error as e:
+            messagebox.showerror(
+                title='Error',
+                message='Problem updating the database',
+                detail=e.pgerror or str(e)
+            )
+            self.destroy()
+            return
 
         # treeview record form
         self.recordlist = v.RecordList(self, self.callbacks,
@@ -96,6 +130,7 @@ class Application(tk.Tk):
         # refresh screen to update recordlist / recordform, solution found below:
         # https://stackoverflow.com/questions/44768319/tkinter-label-not-appearing
         self.update()
+        self.profile('record list populated', since=self.login_time)
 
         # status bar
         self.main_status = tk.StringVar()
@@ -107,9 +142,45 @@ class Application(tk.Tk):
         self.records_updated = 0
         self.records_deleted = 0
 
+    def profile(self, event, since=None):
+        '''Print the time taken to reach event, in --profile-startup mode
+
+        arguments:
+            event - description of the step reached
+            since - perf_counter() value the time is measured from, by
+                    default the start of the process
+        '''
+
+        if self.profile_start is None:
+            return
+        elapsed = time.perf_counter() - (self.profile_start if since is None else since)
+        print(f'{event}: {1000 * elapsed:.0f} ms')
+
+    # records loaded at a time into the record list
+    records_page_size = 200
+
     def populate_recordlist(self):
+        '''Loads the first page of records matching the record list filters'''
+
+        query = self.recordlist.get_query()
+        try:
+            rows = self.data_model.get_records_page(**query, limit=self.records_page_size)
+        except Exception as e:
+            messagebox.showerror(
+                title='Error',
+                message='Problem reading database',
+                detail=str(e)
+            )
+        else:
+            self.recordlist.populate(rows, query, complete=len(rows) < self.records_page_size)
+
+    def load_more_records(self):
+        '''Loads the next page of records when the record list is scrolled down'''
+
         try:
-            rows = self.data_model.get_all_records()
+            rows = self.data_model.get_records_page(**self.recordlist.query,
+                                                    after=self.recordlist.last_key(),
+                                                    limit=self.records_page_size)
         except Exception as e:
             messagebox.showerror(
                 title='Error',
@@ -117,7 +188,24 @@ class Application(tk.Tk):
                 detail=str(e)
             )
         else:
-            self.recordlist.populate(rows)
+            self.recordlist.append(rows, complete=len(rows) < self.records_page_size)
+
+    def refresh_record(self, prop_id):
+        '''Updates the record list row of a single property after a change'''
+
+        try:
+            row = self.data_model.get_record(prop_id)
+        except Exception as e:
+            messagebox.showerror(
+                title='Error',
+                message='Problem reading database',
+                detail=str(e)
+            )
+        else:
+            if row:
+                self.recordlist.update_row(row)
+            else:
+                self.recordlist.delete_row(prop_id)
 
     def open_record(self, rowkey=None):
         '''rowkey is simply prop_id, while data contains the information for the prop_id'''
@@ -169,7 +257,7 @@ class Application(tk.Tk):
             # new property with added tenant
             elif self.data_model.last_write == 'insert tenant':
                 self.inserted_rows.append(key)
-            self.populate_recordlist()
+            self.refresh_record(data['Property ID'])
 
     def open_add_property_window(self):
         '''Opens window for addition of new property into database'''
@@ -224,7 +312,7 @@ class Application(tk.Tk):
                 self.inserted_rows.append(key)
             # reset form only when appending records
             self.propertyform.reset()
-            self.populate_recordlist()
+            self.refresh_record(data['Property ID'])
             self.property_window.destroy()
 
     def open_delete_property_window(self):
@@ -271,16 +359,13 @@ class Application(tk.Tk):
         else:
             self.records_deleted += 1
             self.main_status.set(f'{self.records_deleted} record(s) deleted this session')
-            self.populate_recordlist()
+            self.recordlist.delete_row(data['Property ID'])
             self.delete_window.destroy()
 
     def retrieve_remote_emails(self):
         '''Retrieve emails from remote Microsoft server'''
 
-        self.retrieve_emails(self.recipient_email)
-        rows = self.data_model.get_documents_by_email(self.recipient_email,
-                                                      self.attachment_option.get())
-        self.documentform.populate(rows)
+        self.start_retrieval([self.recipient_email], on_done=self.refresh_documentlist)
 
     def populate_documentlist(self):
         '''Opens list of documents sent by email, first from local database,
@@ -305,18 +390,60 @@ class Application(tk.Tk):
             return
         if rows:
             self.documentform.populate(rows)
+            self.show_documentlist_status()
         else:
-            try:
-                # retrieves email(s) from Microsoft Outlook/Office365/Exchange account
-                self.retrieve_remote_emails()
-            except Exception as e:
-                messagebox.showerror(
-                    title='Error',
-                    message='Problem fetching email(s)',
-                    detail=str(e)
-                )
-                self.docs_status.set('Problem fetching email(s)')
+            # retrieves email(s) from Microsoft Outlook/Office365/Exchange account
+            self.retrieve_remote_emails()
+
+    def refresh_documentlist(self):
+        '''Reloads the document list from the database once emails are retrieved'''
+
+        if not self.docs_window.winfo_exists():
+            return
+        rows = self.data_model.get_documents_by_email(self.recipient_email,
+                                                      self.attachment_option.get())
+        self.documentform.populate(rows)
+        self.documentform.show_more_results(False)
+        self.show_documentlist_status()
 
+    # documents found at a time by a search
+    search_page_size = 100
+
+    def search_documents(self):
+        '''Lists the documents sent to the recipient matching the search box, best first'''
+
+        self.search_text = self.documentform.search.get().strip()
+        if not self.search_text:
+            self.refresh_documentlist()
+            return
+        self.show_search_results(after=None)
+
+    def load_more_search_results(self):
+        '''Appends the next page of documents found by the last search'''
+
+        self.show_search_results(after=self.search_after)
+
+    def show_search_results(self, after):
+        try:
+            rows = self.data_model.search_documents(self.search_text,
+                                                    recipient=self.recipient_email,
+                                                    after=after, limit=self.search_page_size)
+        except Exception as e:
+            messagebox.showerror(
+                title='Error',
+                message='Problem searching documents',
+                detail=str(e)
+            )
+            return
+        self.documentform.populate(rows, append=after is not None)
+        # a full page may be followed by more documents
+        found = len({row['Document ID'] for row in rows})
+        self.search_after = (rows[-1]['Rank'], rows[-1]['Document ID']) if rows else None
+        self.documentform.show_more_results(found == self.search_page_size)
+        self.docs_status.set(f"{self.documentform.count} row(s) sent to {self.recipient_email} "
+                             f"matching '{self.search_text}'")
+
+    def show_documentlist_status(self):
         # status on sent email retrieval
         emails_loaded = str(self.documentform.count)
         retrieved_message = f'''Retrieved emails sent from {self.sent_email_account} to {self.recipient_email}, '''
@@ -372,27 +499,134 @@ class Application(tk.Tk):
                 csv_write = m.CSVModel(filename=self.filename.get(), filepath=None)
                 csv_write.save_record(documents_list, csv_write.document_fields.keys())
 
-    def retrieve_emails(self, email):
-        '''Retrieve list of documents sent by email'''
+    def start_retrieval(self, tenant_emails, on_done=None):
+        '''Start retrieving documents sent by email on the worker thread
 
+        arguments:
+            tenant_emails - list of recipients, all tenants for a single-pass scan
+            on_done - called on the Tk thread after the emails are saved
+        '''
+
+        if self.retrieval is not None and not self.retrieval.done():
+            self.set_retrieval_status('Email retrieval already in progress')
+            return
         try:
-            sent_docs = n.RetrieveSentDocuments(self.settings)
-            messagebox.showinfo(
-                title='Retrieving email(s)',
-                message=f'''Retrieving email(s) sent from {self.sent_email_account}
-                            to {self.recipient_email}.
-                            \n Press button to continue.''',
-            )
-            sent_docs.get(tenant_email=email)
+            store_path = self.settings['attachment_store'].get()
+            store = m.AttachmentStore(store_path) if store_path else None
+            sent_docs = n.RetrieveSentDocuments(self.get_mail_session(), store=store,
+                                                concurrency=self.settings['mail_concurrency'].get())
         except Exception as e:
             messagebox.showerror(
                 title='Error',
                 message='Problem retrieving email(s)',
-                details=str(e)
+                detail=str(e)
+            )
+            self.set_retrieval_status('Problem retrieving email(s)')
+            return
+        self.retrieval_cancel.clear()
+        self.retrieval_done = on_done
+        self.retrieval = self.executor.submit(self.retrieve_emails, sent_docs, tenant_emails)
+        self.set_retrieval_status(f'Retrieving email(s) sent from {sent_docs.account_email}'
+                                  + chr(8230))
+        self.after(self.retrieval_poll_interval, self.poll_retrieval)
+
+    # milliseconds between checks on the worker thread
+    retrieval_poll_interval = 100
+
+    # how often the mail session token is checked, in milliseconds
+    token_check_interval = 60000
+
+    def get_mail_session(self):
+        '''The mail session of the account in the settings, opened if needed'''
+
+        key = (self.settings['account_email'].get(), self.settings['client_id'].get(),
+               self.settings['client_secret'].get())
+        if self.mail_session is None or self.mail_session.key != key:
+            # authentication may prompt on the console, so it stays on this thread
+            first = self.mail_session is None
+            self.mail_session = n.MailSession(self.settings, token_path=self.config_dir)
+            if first:
+                self.after(self.token_check_interval, self.refresh_mail_token)
+        return self.mail_session
+
+    def refresh_mail_token(self):
+        '''Renew the mail session token before it expires, on the worker thread
+
+        The worker runs one task at a time, so a renewal never overlaps with
+        a retrieval using the same connection.
+        '''
+
+        self.executor.submit(self.mail_session.refresh_if_expiring)
+        self.after(self.token_check_interval, self.refresh_mail_token)
+
+    def retrieve_emails(self, sent_docs, tenant_emails):
+        '''Retrieve and save documents sent by email, runs on the worker thread'''
+
+        def progress(scanned, matched):
+            self.retrieval_queue.put((scanned, matched, None))
+
+        inserted = sent_docs.sync(self.data_model, tenant_emails,
+                                  progress=progress, cancel=self.retrieval_cancel)
+        self.retrieval_queue.put((sent_docs.scanned, len(sent_docs.emails), inserted))
+        return sent_docs
+
+    def poll_retrieval(self):
+        '''Show progress of the worker thread, runs on the Tk thread'''
+
+        try:
+            while True:
+                scanned, matched, inserted = self.retrieval_queue.get_nowait()
+                message = f'Retrieving email(s): {scanned} scanned, {matched} matched'
+                if inserted is not None:
+                    message += f', {inserted} saved'
+                self.set_retrieval_status(message)
+        except queue.Empty:
+            pass
+
+        if not self.retrieval.done():
+            self.after(self.retrieval_poll_interval, self.poll_retrieval)
+            return
+        error = self.retrieval.exception()
+        if error is not None:
+            messagebox.showerror(
+                title='Error',
+                message='Problem retrieving email(s)',
+                detail=str(error)
+            )
+            self.set_retrieval_status('Problem retrieving email(s)')
+            return
+        sent_docs = self.retrieval.result()
+        if self.retrieval_done is not None:
+            self.retrieval_done()
+        cancelled = ' (cancelled)' if sent_docs.cancelled else ''
+        self.set_retrieval_status(f'''Retrieved {len(sent_docs.emails)} email(s) from '''
+                                  f'{sent_docs.scanned} scanned{cancelled}')
+
+    def cancel_retrieval(self):
+        '''Stop the running email retrieval, emails matched so far are kept'''
+
+        if self.retrieval is not None and not self.retrieval.done():
+            self.retrieval_cancel.set()
+            self.set_retrieval_status('Cancelling email retrieval' + chr(8230))
+
+    def set_retrieval_status(self, message):
+        self.main_status.set(message)
+        if hasattr(self, 'docs_window') and self.docs_window.winfo_exists():
+            self.docs_status.set(message)
+
+    def retrieve_all_emails(self):
+        '''Retrieve documents sent by email to all tenants in a single pass'''
+
+        try:
+            tenant_emails = self.data_model.get_tenant_emails()
+        except Exception as e:
+            messagebox.showerror(
+                title='Error',
+                message='Problem reading database',
+                detail=str(e)
             )
         else:
-            for email in sent_docs.emails:
-                self.data_model.insert_retrieved_documents(email)
+            self.start_retrieval(tenant_emails)
 
     # import records from CSV file to database
     def on_file_import(self):
@@ -401,27 +635,40 @@ class Application(tk.Tk):
         filename = filedialog.askopenfilename(
             title='Select the file to import into the database',
             defaultextension='.csv',
-            filetypes=[('Comma-Separated Values', '*.csv *.CSV')]
+            filetypes=[('Comma-Separated Values', '*.csv *.CSV'),
+                       ('Compressed Comma-Separated Values', '*.csv.gz')]
         )
         if filename:
             self.filename.set(filename)
             try:
                 csv_read = m.CSVModel(filename=self.filename.get(),
                                       filepath=None)
+                columns = csv_read.get_fieldnames()
+                with csv_read.open() as fh:
+                    results = self.data_model.import_records(fh, columns)
             except Exception as e:
                 messagebox.showerror(
                     title='Error',
-                    message='Problem reading file',
+                    message='Problem importing file',
                     detail=str(e)
                 )
+                self.main_status.set('Problem importing file')
             else:
-                records = csv_read.get_all_records()
-                for row in records:
-                    self.data_model.add_landlords(row)
-                for row in records:
-                    self.data_model.add_property(row)
-                    self.data_model.add_tenant(row)
-                self.main_status.set(f'''Loaded data into {self.settings['db_name'].get()}''')
+                rejects = results['rejects']
+                rate = results['rows'] / max(results['seconds'], 1e-6)
+                db_name = self.settings['db_name'].get()
+                self.main_status.set(f'''Loaded {results['imported']} record(s) into {db_name} '''
+                                     f'({rate:.0f} rows/sec), {len(rejects)} rejected')
+                if rejects:
+                    # only the first rejects are listed in the dialog
+                    detail = '\n'.join(f'Line {line}: {reason}' for line, reason in rejects[:20])
+                    if len(rejects) > 20:
+                        detail += f'\n{chr(8230)} and {len(rejects) - 20} more'
+                    messagebox.showwarning(
+                        title='Import',
+                        message=f'{len(rejects)} row(s) rejected',
+                        detail=detail
+                    )
                 self.populate_recordlist()
 
     # save records to CSV file
@@ -431,23 +678,26 @@ class Application(tk.Tk):
         filename = filedialog.asksaveasfilename(
             title='Select the target file for saving records',
             defaultextension='.csv',
-            filetypes=[('Comma-Separated Values', '*.csv *.CSV')]
+            filetypes=[('Comma-Separated Values', '*.csv *.CSV'),
+                       ('Compressed Comma-Separated Values', '*.csv.gz')]
         )
         if filename:
             self.filename.set(filename)
             try:
-                rows = self.data_model.get_all_records()
+                # rows are streamed from the database straight to the file
+                csv_write = m.CSVModel(filename=self.filename.get(),
+                                       filepath=None)
+                with csv_write.open('w') as fh:
+                    row_count = self.data_model.export_records(fh)
             except Exception as e:
                 messagebox.showerror(
                     title='Error',
-                    message='Problem reading database',
+                    message='Problem exporting records',
                     detail=str(e)
                 )
+                self.main_status.set('Problem exporting records')
             else:
-                self.main_status.set(f'Saved data to {self.filename.get()}')
-                csv_write = m.CSVModel(filename=self.filename.get(),
-                                       filepath=None)
-                csv_write.save_record(rows, csv_write.fields.keys())
+                self.main_status.set(f'Saved {row_count} record(s) to {self.filename.get()}')
 
     def show_number_of_properties_by_landlord(self):
         popup = tk.Toplevel()
@@ -469,6 +719,11 @@ class Application(tk.Tk):
         data = self.data_model.get_occupancy_by_building()
         bar_chart.draw_bar_chart(data)
 
+    def destroy(self):
+        # let a running email retrieval stop before the window goes
+        self.retrieval_cancel.set()
+        super().destroy()
+
     def load_settings(self):
         '''Load settings into our self.settings dict'''
 
@@ -503,14 +758,20 @@ class Application(tk.Tk):
         db_name = self.settings['db_name'].get()
         title = f'Login to {db_name} at {db_host}'
         error = ''
+        # runs once the first dialog is drawn and waiting for input
+        self.after_idle(self.profile, 'login dialog shown')
         while True:
             login = v.LoginDialog(self, title, error)
             if not login.result:
                 break
             else:
+                # the time spent typing isn't part of the startup
+                self.login_time = time.perf_counter()
                 username, password = login.result
                 try:
-                    self.data_model = m.SQLModel(db_host, db_name, username, password)
+                    self.data_model = m.SQLModel(db_host, db_name, username, password,
+                                                 minconn=self.settings['db_pool_min'].get(),
+                                                 maxconn=self.settings['db_pool_max'].get())
                 except m.pg.OperationalError:
                     error = 'Login failed'
                 else:
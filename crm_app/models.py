@@ -1,10 +1,24 @@
 import csv
+import gzip
+import hashlib
+import mmap
 import os
 import json
-import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from .constants import FieldTypes as FT
 import psycopg2 as pg
-from psycopg2.extras import DictCursor
+from psycopg2 import sql
+from psycopg2.extras import DictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+
+def like_escape(text):
+    '''Text matched literally by LIKE, its wildcards typed by the user escaped'''
+
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 
 class SQLModel:
@@ -30,79 +44,36 @@ class SQLModel:
         'Email': {'req': True, 'type': FT.string},
     }
 
-    # create user and database if not existing
-    subprocess.run('createuser -s crm', shell=True, stderr=subprocess.DEVNULL)
-    subprocess.run('createdb -O crm housing_management', shell=True, stderr=subprocess.DEVNULL)
-
-    # create tables if not existing
-    create_ll_table_command = ('CREATE TABLE IF NOT EXISTS landlords '
-                               '(ll_id VARCHAR(6) UNIQUE NOT NULL, '
-                               'PRIMARY KEY(ll_id))')
-
-    create_pr_table_command = ('CREATE TABLE IF NOT EXISTS properties '
-                               '(prop_id VARCHAR(7) UNIQUE NOT NULL, '
-                               'll_id VARCHAR(6) NOT NULL REFERENCES '
-                               'landlords(ll_id) ON DELETE CASCADE ON UPDATE CASCADE, '
-                               'num_prop_building INT NOT NULL, '
-                               'flat_num VARCHAR(3) NOT NULL, '
-                               'street VARCHAR(60) NOT NULL, '
-                               'post_code VARCHAR(10) NOT NULL, '
-                               'city VARCHAR(20) NOT NULL, '
-                               'PRIMARY KEY(prop_id))')
-
-    create_tn_table_command = ('CREATE TABLE IF NOT EXISTS tenants '
-                               '(prop_id VARCHAR(7) NOT NULL REFERENCES '
-                               'properties(prop_id) ON DELETE CASCADE ON UPDATE CASCADE, '
-                               'first_name VARCHAR(20), '
-                               'last_name VARCHAR(20), '
-                               'email VARCHAR(60), '
-                               'PRIMARY KEY(email))')
-
-    create_dc_table_command = ('CREATE TABLE IF NOT EXISTS documents '
-                               '(subject VARCHAR(200), '
-                               'recipient VARCHAR(60) NOT NULL REFERENCES '
-                               'tenants(email) ON DELETE CASCADE ON UPDATE CASCADE, '
-                               'date_sent TIMESTAMP, '
-                               'date_retrieved TIMESTAMP, '
-                               'attachments VARCHAR(200), '
-                               'PRIMARY KEY(date_sent))')
-
-    create_prop_tenant_view_command = ('CREATE OR REPLACE VIEW prop_tenant_view AS '
-                                       '(SELECT pr.prop_id AS "Property ID", '
-                                       'pr.ll_id AS "Landlord ID", '
-                                       'pr.num_prop_building AS "Number properties in building", '
-                                       'pr.flat_num AS "Flat number", '
-                                       'pr.street AS "Street", '
-                                       'pr.post_code AS "Post code", '
-                                       'pr.city AS "City", '
-                                       'tn.first_name AS "First name", '
-                                       'tn.last_name AS "Last name", '
-                                       'tn.email AS "Email" '
-                                       'FROM properties AS pr '
-                                       'LEFT JOIN tenants AS tn '
-                                       'ON pr.prop_id = tn.prop_id)')
-
-    create_doc_tenant_view_command = ('CREATE OR REPLACE VIEW doc_tenant_view AS '
-                                      '(SELECT tn.prop_id AS "Property ID", '
-                                      'tn.first_name AS "First name", '
-                                      'tn.last_name AS "Last name", '
-                                      'dc.recipient AS "Recipient", '
-                                      'dc.subject AS "Subject", '
-                                      'dc.date_sent AS "Date sent", '
-                                      'dc.date_retrieved AS "Date retrieved", '
-                                      'dc.attachments AS "Attachments" '
-                                      'FROM documents AS dc '
-                                      'JOIN tenants AS tn '
-                                      'ON dc.recipient = tn.email)')
-
-    # insert tenant in existing property
-    tenants_insert_query = ('INSERT INTO tenants VALUES (%(Property ID)s, '
-                            '%(First name)s, %(Last name)s, %(Email)s) ')
-
-    # update tenant in existing property
-    tenants_update_query = ('UPDATE tenants SET first_name=%(First name)s, '
-                            'last_name=%(Last name)s, email=%(Email)s WHERE '
-                            'prop_id = %(Property ID)s')
+    # database provisioning, see provision()
+    role_exists_query = 'SELECT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = %s)'
+    database_exists_query = 'SELECT EXISTS (SELECT 1 FROM pg_database WHERE datname = %s)'
+    # owning the database is enough to create and migrate the schema
+    create_role_command = 'CREATE ROLE {role} LOGIN'
+    create_database_command = 'CREATE DATABASE {database} OWNER {role}'
+
+    # schema migrations, sql/NNN_description.sql files applied in version
+    # order, once; the version reached is stored in the schema_version table
+    migrations_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   os.pardir, 'sql')
+
+    create_sv_table_command = ('CREATE TABLE IF NOT EXISTS schema_version '
+                               '(version INT NOT NULL, '
+                               'applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP(0), '
+                               'PRIMARY KEY(version))')
+
+    schema_version_query = 'SELECT COALESCE(MAX(version), 0) AS version FROM schema_version'
+
+    # serializes the migrations of applications starting at the same time
+    migrations_lock_key = 20230713
+
+    # insert tenant in existing property, or replace the tenant already
+    # living there; xmax is 0 only for freshly inserted rows
+    tenants_upsert_query = ('INSERT INTO tenants (prop_id, first_name, last_name, email) '
+                            'VALUES %s ON CONFLICT (prop_id) DO UPDATE SET '
+                            'first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name, '
+                            'email = EXCLUDED.email RETURNING prop_id, (xmax = 0) AS inserted')
+
+    tenants_upsert_template = '(%(Property ID)s, %(First name)s, %(Last name)s, %(Email)s)'
 
     # insert new property, used rarely
     propriety_insert_query = ('INSERT INTO properties VALUES (%(Property ID)s, '
@@ -112,56 +83,437 @@ class SQLModel:
     # insert new landlord, used only on initial CRM app setup
     landlords_insert_query = ('INSERT INTO landlords (ll_id) VALUES (%(Landlord ID)s)')
 
-    # retrieve and insert new emails in documents table
-    documents_insert_query = ('INSERT INTO documents (subject, recipient, date_sent, '
-                              'date_retrieved, attachments) VALUES (%(Subject)s, '
-                              '%(Recipient)s, %(Date sent)s, CURRENT_TIMESTAMP(0), '
-                              '%(Attachments)s) ON CONFLICT (date_sent) DO UPDATE '
-                              'SET date_retrieved = CURRENT_TIMESTAMP(0)')
-
-    remove_old_emails_query = ('DELETE FROM documents WHERE date_retrieved < (SELECT '
-                               'MIN(date_retrieved) FROM documents WHERE recipient = '
-                               '%(Recipient)s) AND recipient = %(Recipient)s')
+    # insert or refresh many retrieved emails at once, together with their
+    # attachments, a JSON array of objects with name, size, content_type and
+    # the sha256 of the content in the attachment store, if downloaded;
+    # attachments without a name are saved with an empty one, long names cut
+    documents_batch_insert_query = ('WITH batch (subject, recipient, date_sent, attachments) '
+                                    'AS (VALUES %s), '
+                                    'docs AS (INSERT INTO documents (subject, recipient, '
+                                    'date_sent, date_retrieved) SELECT subject, recipient, '
+                                    'date_sent, CURRENT_TIMESTAMP(0) FROM batch '
+                                    'ON CONFLICT (recipient, date_sent) DO UPDATE '
+                                    'SET date_retrieved = CURRENT_TIMESTAMP(0) '
+                                    'RETURNING doc_id, recipient, date_sent) '
+                                    'INSERT INTO document_attachments (doc_id, position, name, '
+                                    'size, content_type, sha256) SELECT docs.doc_id, '
+                                    'at.position, LEFT(COALESCE(at.name, \'\'), 255), at.size, '
+                                    'at.content_type, at.sha256 '
+                                    'FROM docs JOIN batch USING (recipient, date_sent), '
+                                    'ROWS FROM (jsonb_to_recordset(batch.attachments) '
+                                    'AS (name VARCHAR, size INT, content_type VARCHAR, '
+                                    'sha256 CHAR(64))) WITH ORDINALITY '
+                                    'AS at(name, size, content_type, sha256, position) '
+                                    'ON CONFLICT (doc_id, position) DO UPDATE '
+                                    'SET name = EXCLUDED.name, size = EXCLUDED.size, '
+                                    'content_type = EXCLUDED.content_type, '
+                                    'sha256 = COALESCE(EXCLUDED.sha256, '
+                                    'document_attachments.sha256)')
+
+    documents_batch_insert_template = ('(%(Subject)s, %(Recipient)s, %(Date sent)s::TIMESTAMP, '
+                                       '%(Attachments)s::JSONB)')
+    # emails upserted per statement
+    documents_batch_size = 1000
+
+    # documents matching a search, best first: the subject words through the
+    # full-text index, attachment names as substrings, the ranks of both
+    # adding up; pages of documents are taken before their attachment rows
+    search_documents_query = ('WITH matches AS ('
+                              'SELECT doc_id, ts_rank(search_vector, websearch_to_tsquery('
+                              '\'english\', %(query)s))::FLOAT8 AS rank FROM documents '
+                              'WHERE search_vector @@ websearch_to_tsquery(\'english\', %(query)s) '
+                              'UNION ALL SELECT doc_id, %(attachment_rank)s::FLOAT8 '
+                              'FROM document_attachments WHERE name ILIKE %(pattern)s), '
+                              'ranked AS (SELECT doc_id, SUM(rank) AS rank FROM matches '
+                              'JOIN documents AS dc USING (doc_id) '
+                              'WHERE (%(recipient)s IS NULL OR dc.recipient = %(recipient)s) '
+                              'AND (%(first)s IS NULL OR dc.date_sent >= %(first)s::DATE) '
+                              'AND (%(last)s IS NULL OR dc.date_sent < %(last)s::DATE + 1) '
+                              'GROUP BY doc_id), '
+                              'page AS (SELECT doc_id, rank FROM ranked '
+                              'WHERE %(after_rank)s IS NULL OR rank < %(after_rank)s '
+                              'OR (rank = %(after_rank)s AND doc_id > %(after_id)s) '
+                              'ORDER BY rank DESC, doc_id LIMIT %(limit)s) '
+                              'SELECT page.rank AS "Rank", dv.* FROM page '
+                              'JOIN doc_tenant_view AS dv ON dv."Document ID" = page.doc_id '
+                              'ORDER BY page.rank DESC, page.doc_id, dv."Attachment number"')
+
+    # rank of a match in an attachment name, about that of a subject word
+    attachment_match_rank = 0.1
+
+    # the sync time only ever moves forward
+    last_sent_upsert_query = ('INSERT INTO mail_sync_state (mailbox, recipient, last_sent) '
+                              'VALUES %s ON CONFLICT (mailbox, recipient) DO UPDATE SET last_sent = '
+                              'GREATEST(mail_sync_state.last_sent, EXCLUDED.last_sent)')
+
+    # after a complete retrieval, documents of its recipients that the same
+    # transaction didn't refresh are no longer on the server
+    prune_documents_query = ('DELETE FROM documents WHERE recipient = ANY(%(recipients)s) '
+                             'AND date_retrieved < CURRENT_TIMESTAMP(0)')
+
+    # contents already in the attachment store, for the documents of the
+    # recipients saved by earlier retrievals, sent since a time if given
+    attachment_digests_query = ('SELECT dc.recipient, dc.date_sent, at.position, at.sha256 '
+                                'FROM documents AS dc JOIN document_attachments AS at '
+                                'USING (doc_id) WHERE dc.recipient = ANY(%(recipients)s) '
+                                'AND (%(since)s::TIMESTAMP IS NULL '
+                                'OR dc.date_sent >= %(since)s::TIMESTAMP) '
+                                'AND at.sha256 IS NOT NULL')
 
     # delete old property, used rarely
     propriety_delete_query = ('DELETE FROM properties WHERE prop_id = %(Property ID)s')
 
-    def __init__(self, host, database, user, password):
-        self.connection = pg.connect(host=host, database=database, user=user,
-                                     password=password, cursor_factory=DictCursor)
+    # bulk import: CSV rows are copied as text into a temporary staging table,
+    # checked in one pass and then merged into the lookup tables set-wise
+    import_staging_table_command = ('CREATE TEMPORARY TABLE import_staging '
+                                    '(line_no SERIAL, {columns}) ON COMMIT DROP')
+
+    import_copy_command = ('COPY import_staging ({columns}) FROM STDIN '
+                           'WITH (FORMAT csv, HEADER true)')
+
+    # removes invalid rows from the staging table and reports them
+    import_rejects_query = ('WITH checked AS (SELECT line_no, CASE '
+                            'WHEN NULLIF("Property ID", \'\') IS NULL THEN \'missing Property ID\' '
+                            'WHEN NULLIF("Landlord ID", \'\') IS NULL THEN \'missing Landlord ID\' '
+                            'WHEN NULLIF("Flat number", \'\') IS NULL THEN \'missing Flat number\' '
+                            'WHEN NULLIF("Street", \'\') IS NULL THEN \'missing Street\' '
+                            'WHEN NULLIF("Post code", \'\') IS NULL THEN \'missing Post code\' '
+                            'WHEN NULLIF("City", \'\') IS NULL THEN \'missing City\' '
+                            'WHEN COALESCE("Number properties in building", \'\') '
+                            '!~ \'^\\s*[0-9]{1,9}\\s*$\' THEN \'invalid Number properties in building\' '
+                            'WHEN LENGTH("Property ID") > 7 THEN \'Property ID too long\' '
+                            'WHEN LENGTH("Landlord ID") > 6 THEN \'Landlord ID too long\' '
+                            'WHEN LENGTH("Flat number") > 3 THEN \'Flat number too long\' '
+                            'WHEN LENGTH("Street") > 60 THEN \'Street too long\' '
+                            'WHEN LENGTH("Post code") > 10 THEN \'Post code too long\' '
+                            'WHEN LENGTH("City") > 20 THEN \'City too long\' '
+                            'WHEN LENGTH("First name") > 20 THEN \'First name too long\' '
+                            'WHEN LENGTH("Last name") > 20 THEN \'Last name too long\' '
+                            'WHEN LENGTH("Email") > 60 THEN \'Email too long\' '
+                            'WHEN NULLIF("Email", \'\') IS NOT NULL AND ROW_NUMBER() OVER '
+                            '(PARTITION BY "Email" ORDER BY line_no DESC) > 1 '
+                            'THEN \'duplicate Email\' '
+                            'WHEN EXISTS (SELECT 1 FROM tenants AS tn '
+                            'WHERE tn.email = import_staging."Email" '
+                            'AND tn.prop_id <> import_staging."Property ID") '
+                            'THEN \'Email of the tenant of another property\' '
+                            'END AS reason FROM import_staging) '
+                            'DELETE FROM import_staging AS st USING checked '
+                            'WHERE st.line_no = checked.line_no AND checked.reason IS NOT NULL '
+                            'RETURNING st.line_no, checked.reason')
+
+    import_landlords_query = ('INSERT INTO landlords (ll_id) SELECT DISTINCT "Landlord ID" '
+                              'FROM import_staging ON CONFLICT (ll_id) DO NOTHING')
+
+    # the last row in the file wins when a property is listed more than once
+    import_properties_query = ('INSERT INTO properties (prop_id, ll_id, num_prop_building, '
+                               'flat_num, street, post_code, city) '
+                               'SELECT DISTINCT ON ("Property ID") "Property ID", "Landlord ID", '
+                               'CAST("Number properties in building" AS INT), "Flat number", '
+                               '"Street", "Post code", "City" FROM import_staging '
+                               'ORDER BY "Property ID", line_no DESC '
+                               'ON CONFLICT (prop_id) DO UPDATE SET ll_id = EXCLUDED.ll_id, '
+                               'num_prop_building = EXCLUDED.num_prop_building, '
+                               'flat_num = EXCLUDED.flat_num, street = EXCLUDED.street, '
+                               'post_code = EXCLUDED.post_code, city = EXCLUDED.city')
+
+    # rows without tenant email are vacant properties
+    import_tenants_query = ('INSERT INTO tenants (prop_id, first_name, last_name, email) '
+                            'SELECT DISTINCT ON ("Property ID") "Property ID", '
+                            '"First name", "Last name", "Email" FROM import_staging '
+                            'WHERE NULLIF("Email", \'\') IS NOT NULL '
+                            'ORDER BY "Property ID", line_no DESC '
+                            'ON CONFLICT (prop_id) DO UPDATE SET first_name = EXCLUDED.first_name, '
+                            'last_name = EXCLUDED.last_name, email = EXCLUDED.email')
+
+    # record list filters on prop_tenant_view, other than landlord
+    # and tenant presence they match the start of the column value
+    record_filters = {
+        'Landlord ID': '"Landlord ID" = %(Landlord ID)s',
+        'Street': '"Street" ILIKE %(Street)s',
+        'Post code': '"Post code" ILIKE %(Post code)s',
+        'City': '"City" ILIKE %(City)s',
+        'Name': '("First name" ILIKE %(Name)s OR "Last name" ILIKE %(Name)s)',
+        'Email': '"Email" ILIKE %(Email)s',
+    }
 
-    def query(self, query, parameters=None):
-        cursor = self.connection.cursor()
+    # record list sort columns, vacant properties have no tenant values
+    record_sort_columns = ['Property ID', 'Landlord ID', 'Number properties in building',
+                           'Flat number', 'Street', 'Post code', 'City']
+    record_nullable_sort_columns = ['First name', 'Last name', 'Email']
+
+    # seconds a pooled connection can stay idle before being checked on checkout
+    health_check_interval = 60
+
+    def __init__(self, host, database, user, password, minconn=1, maxconn=5):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, host=host, database=database,
+                                           user=user, password=password,
+                                           cursor_factory=DictCursor)
+        # makes borrowers wait for a free connection instead of raising PoolError
+        self.pool_slots = threading.BoundedSemaphore(maxconn)
+        self.last_used = {}
+        # open transaction of each thread, see transaction()
+        self.local = threading.local()
+
+    def _is_healthy(self, conn):
+        # connections used recently are trusted without a round trip
+        if time.monotonic() - self.last_used.get(conn, 0) < self.health_check_interval:
+            return True
         try:
-            cursor.execute(query, parameters)
-        except (pg.Error) as e:
-            self.connection.rollback()
-            raise e
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except (pg.Error):
+            return False
+        return True
+
+    def _checkout(self):
+        self.pool_slots.acquire()
+        try:
+            while True:
+                conn = self.pool.getconn()
+                if not conn.closed and self._is_healthy(conn):
+                    return conn
+                # broken connection, the pool opens a new one on the next getconn()
+                self.last_used.pop(conn, None)
+                self.pool.putconn(conn, close=True)
+        except Exception:
+            self.pool_slots.release()
+            raise
+
+    def _checkin(self, conn):
+        # the pool closes connections beyond minconn when they are returned
+        self.pool.putconn(conn, close=bool(conn.closed))
+        if conn.closed:
+            self.last_used.pop(conn, None)
         else:
-            self.connection.commit()
+            self.last_used[conn] = time.monotonic()
+        self.pool_slots.release()
+
+    @contextmanager
+    def connection(self):
+        '''Borrow a connection from the pool for the duration of the block'''
+
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    @contextmanager
+    def transaction(self):
+        '''Run the statements of the block in one transaction, yields a cursor
+
+        Queries issued in the same thread while the block is open join the
+        transaction and are committed together when it ends, or rolled back
+        if it raises. A nested block becomes a savepoint, so a failure inside
+        it only undoes the nested statements:
+
+            with model.transaction():
+                for record in records:
+                    try:
+                        with model.transaction():
+                            model.add_tenant(record)
+                    except pg.Error:
+                        pass
+        '''
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.depth += 1
+            savepoint = f'sp_{self.local.depth}'
+            cursor = conn.cursor()
+            cursor.execute(f'SAVEPOINT {savepoint}')
+            try:
+                yield cursor
+            except Exception:
+                if not conn.closed:
+                    cursor.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
+                raise
+            else:
+                cursor.execute(f'RELEASE SAVEPOINT {savepoint}')
+            finally:
+                self.local.depth -= 1
+            return
+
+        with self.connection() as conn:
+            self.local.conn, self.local.depth = conn, 0
+            try:
+                yield conn.cursor()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                self.local.conn = None
+
+    @classmethod
+    def provision(cls, host, user, password, database='housing_management', owner='crm',
+                  maintenance_database='postgres'):
+        '''Create the owner role and the application database if they don't exist
+
+        Connects to the maintenance database as user, normally a superuser
+        such as postgres. Running it again changes nothing.
+        Returns a dict of the role and database names created.
+        '''
+
+        created = {}
+        conn = pg.connect(host=host, database=maintenance_database, user=user,
+                          password=password)
+        # CREATE DATABASE can't run inside a transaction
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(cls.role_exists_query, (owner,))
+                if not cursor.fetchone()[0]:
+                    cursor.execute(sql.SQL(cls.create_role_command).format(
+                        role=sql.Identifier(owner)))
+                    created['role'] = owner
+                cursor.execute(cls.database_exists_query, (database,))
+                if not cursor.fetchone()[0]:
+                    cursor.execute(sql.SQL(cls.create_database_command).format(
+                        database=sql.Identifier(database), role=sql.Identifier(owner)))
+                    created['database'] = database
+        finally:
+            conn.close()
+        return created
+
+    def close(self):
+        '''Close all pooled connections'''
+
+        self.pool.closeall()
+
+    def query(self, query, parameters=None):
+        # join the open transaction of this thread, committed when it ends
+        if getattr(self.local, 'conn', None) is not None:
+            cursor = self.local.conn.cursor()
+            cursor.execute(query, parameters)
             if cursor.description is not None:
                 return cursor.fetchall()
+            return None
+
+        for attempt in range(2):
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(query, parameters)
+                except (pg.Error) as e:
+                    # the server dropped the connection before running
+                    # the statement, retry once on a fresh connection
+                    if conn.closed and attempt == 0:
+                        continue
+                    if not conn.closed:
+                        conn.rollback()
+                    raise e
+                else:
+                    conn.commit()
+                    if cursor.description is not None:
+                        return cursor.fetchall()
+                    return None
 
-    # only upon first run of the crm application
     def create_db_and_tables(self):
-        '''Creates database and tables if they don't already exist'''
+        '''Brings the database schema up to date and loads the property IDs'''
 
-        self.query(self.create_ll_table_command)
-        self.query(self.create_pr_table_command)
-        self.query(self.create_tn_table_command)
-        self.query(self.create_dc_table_command)
-        self.query(self.create_prop_tenant_view_command)
-        self.query(self.create_doc_tenant_view_command)
+        self.migrate()
 
         # parses property values once database, tables and views exist
         prop_ids = self.query("SELECT prop_id FROM properties ORDER BY prop_id")
         self.fields['Property ID Dropdown']['values'] = [x['prop_id'] for x in prop_ids]
 
+    def get_migrations(self):
+        '''(version, path) of the migration files, in version order'''
+
+        migrations = []
+        for filename in os.listdir(self.migrations_path):
+            version = filename.split('_', 1)[0]
+            if version.isdigit() and filename.endswith('.sql'):
+                path = os.path.join(self.migrations_path, filename)
+                migrations.append((int(version), path))
+        return sorted(migrations)
+
+    def migrate(self):
+        '''Apply the migrations newer than the schema version of the database
+
+        An up to date database costs a single query. Pending migrations are
+        applied together in one transaction, so a failing migration leaves
+        the database at its previous version.
+        '''
+
+        migrations = self.get_migrations()
+        try:
+            current = self.query(self.schema_version_query)[0]['version']
+        except pg.errors.UndefinedTable:
+            current = 0
+        if current >= migrations[-1][0]:
+            return
+
+        with self.transaction() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (self.migrations_lock_key,))
+            cursor.execute(self.create_sv_table_command)
+            # another application may have migrated while waiting for the lock
+            cursor.execute(self.schema_version_query)
+            current = cursor.fetchone()['version']
+            for version, path in migrations:
+                if version <= current:
+                    continue
+                with open(path) as fh:
+                    cursor.execute(fh.read())
+                cursor.execute('INSERT INTO schema_version (version) VALUES (%(version)s)',
+                               {'version': version})
+
     def get_all_records(self):
         query = ('SELECT * FROM prop_tenant_view '
                  'ORDER BY "Property ID"')
         return self.query(query)
 
+    def get_records_page(self, filters=None, sort_column='Property ID', descending=False,
+                         after=None, limit=200):
+        '''One page of records from prop_tenant_view, using keyset pagination
+
+        arguments:
+            filters - dict of values by key of record_filters, plus 'Tenant'
+                      set to True or False for occupied or vacant properties
+            sort_column - column the records are ordered by, then by Property ID
+            descending - reverses the order
+            after - (sort column value, Property ID) of the last record of
+                    the previous page, None for the first page
+            limit - maximum number of records returned
+        '''
+
+        sort_key = sql.Identifier(sort_column)
+        if sort_column in self.record_nullable_sort_columns:
+            sort_key = sql.SQL("COALESCE({}, '')").format(sort_key)
+        elif sort_column not in self.record_sort_columns:
+            raise ValueError(f'Cannot sort records by {sort_column}')
+
+        conditions = []
+        parameters = {'limit': limit}
+        for key, value in (filters or {}).items():
+            if value is None or value == '':
+                continue
+            if key == 'Tenant':
+                conditions.append(sql.SQL('"Email" IS NOT NULL' if value else '"Email" IS NULL'))
+            elif key == 'Landlord ID':
+                conditions.append(sql.SQL(self.record_filters[key]))
+                parameters[key] = value
+            else:
+                conditions.append(sql.SQL(self.record_filters[key]))
+                parameters[key] = like_escape(value) + '%'
+        if after is not None:
+            comparison = '<' if descending else '>'
+            conditions.append(sql.SQL('({}, "Property ID") {} (%(after_value)s, %(after_id)s)')
+                              .format(sort_key, sql.SQL(comparison)))
+            parameters['after_value'], parameters['after_id'] = after
+
+        direction = sql.SQL('DESC' if descending else 'ASC')
+        query = sql.SQL('SELECT * FROM prop_tenant_view {where} ORDER BY {key} {direction}, '
+                        '"Property ID" {direction} LIMIT %(limit)s').format(
+            where=sql.SQL('WHERE ') + sql.SQL(' AND ').join(conditions) if conditions else sql.SQL(''),
+            key=sort_key, direction=direction)
+        return self.query(query, parameters)
+
     def get_record(self, prop_id):
         query = ('SELECT * FROM prop_tenant_view '
                  'WHERE "Property ID" = %(prop_id)s')
@@ -169,22 +521,23 @@ class SQLModel:
         return result[0] if result else {}
 
     def add_tenant(self, record):
-        # add or update tenant information
-        prop_id = record['Property ID']
-        results = self.get_record(prop_id)
-        first_name, last_name = results[7], results[8]
-        # if the property exists but doesn't have any tenant
-        # information, add tenant data to the property
-        if (first_name is None and last_name is None):
-            tenant_query = self.tenants_insert_query
-            self.last_write = 'insert tenant'
-        # if the property already contains a tenant, update
-        # the property with the new tenant information
-        elif (isinstance(first_name, str) and isinstance(last_name, str)):
-            tenant_query = self.tenants_update_query
-            self.last_write = 'update tenant'
-
-        self.query(tenant_query, record)
+        # add tenant to the property, or update the tenant already there
+        last_writes = self.add_tenants([record])
+        self.last_write = last_writes[record['Property ID']]
+
+    def add_tenants(self, records):
+        '''Add or update the tenants of many properties in one statement
+
+        Returns a dict of 'insert tenant' / 'update tenant' by Property ID.
+        '''
+
+        # a row can only be upserted once per statement, the last record wins
+        latest = {record['Property ID']: record for record in records}
+        with self.transaction() as cursor:
+            results = execute_values(cursor, self.tenants_upsert_query, list(latest.values()),
+                                     template=self.tenants_upsert_template, fetch=True)
+        return {row['prop_id']: 'insert tenant' if row['inserted'] else 'update tenant'
+                for row in results}
 
     def add_property(self, record):
         # add property information
@@ -195,8 +548,10 @@ class SQLModel:
     def add_landlords(self, record):
         # add property information
         landlords_query = self.landlords_insert_query
+        # savepoint keeps an open transaction usable after the error
         try:
-            self.query(landlords_query, record)
+            with self.transaction():
+                self.query(landlords_query, record)
         # landlord(s) are already present in the database
         except pg.IntegrityError:
             pass
@@ -206,36 +561,156 @@ class SQLModel:
         property_query = self.propriety_delete_query
         self.query(property_query, record)
 
-    def insert_retrieved_documents(self, email):
-        # insert retrieved email(s) in documents table
-        self.query(self.documents_insert_query, email)
-        # remove email(s) from  documents table that are
-        # no longer present on server
-        self.query(self.remove_old_emails_query, email)
+    def insert_retrieved_documents(self, emails, recipients=None):
+        '''Save the emails of a retrieval in one transaction, returns the number saved
+
+        arguments:
+            emails - records of the retrieved emails
+            recipients - tenants whose sent emails were all retrieved, their
+                         documents no longer on the server are removed
+        '''
+
+        with self.transaction() as cursor:
+            inserted = self.insert_documents(emails)
+            # once per retrieval, the recipient index finds their documents
+            if recipients:
+                cursor.execute(self.prune_documents_query, {'recipients': list(recipients)})
+        return inserted
+
+    def get_attachment_digests(self, recipients, since=None):
+        '''Digests of the stored attachment contents, by (recipient, date sent, position)
+
+        since limits them to the documents sent from that time onwards, a
+        time without offset as in Date sent.
+        '''
+
+        rows = self.query(self.attachment_digests_query,
+                          {'recipients': list(recipients), 'since': since})
+        return {(row['recipient'], row['date_sent'], row['position']): row['sha256']
+                for row in rows}
+
+    def import_records(self, fh, columns):
+        '''Bulk import of CSV data into the database in a single transaction
+
+        arguments:
+            fh - open CSV file, starting with the header line
+            columns - field names in the CSV header, in file order
+        '''
+
+        start = time.perf_counter()
+        column_list = sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+        staging_columns = sql.SQL(', ').join(sql.SQL('{} TEXT').format(sql.Identifier(column))
+                                             for column in columns)
+        with self.transaction() as cursor:
+            cursor.execute(sql.SQL(self.import_staging_table_command).format(columns=staging_columns))
+            cursor.copy_expert(sql.SQL(self.import_copy_command).format(columns=column_list)
+                               .as_string(cursor), fh)
+            total = cursor.rowcount
+            cursor.execute(self.import_rejects_query)
+            # line numbers in the file, counting the header line
+            rejects = sorted((row['line_no'] + 1, row['reason']) for row in cursor.fetchall())
+            cursor.execute(self.import_landlords_query)
+            cursor.execute(self.import_properties_query)
+            cursor.execute(self.import_tenants_query)
+        return {'rows': total, 'imported': total - len(rejects), 'rejects': rejects,
+                'seconds': time.perf_counter() - start}
+
+    def export_records(self, fh):
+        '''Stream all records to an open CSV file, returns the number of rows'''
+
+        query = ('COPY (SELECT * FROM prop_tenant_view ORDER BY "Property ID") '
+                 'TO STDOUT WITH (FORMAT csv, HEADER true)')
+        with self.transaction() as cursor:
+            cursor.copy_expert(query, fh)
+        return cursor.rowcount
+
+    def get_last_sent(self, mailbox, recipients):
+        '''Time up to which emails to all recipients were retrieved from mailbox
+
+        Returns None if any of the recipients was never synchronised.
+        '''
+
+        query = ('SELECT CASE WHEN COUNT(st.last_sent) < COUNT(*) THEN NULL '
+                 'ELSE MIN(st.last_sent) END AS last_sent '
+                 'FROM UNNEST(CAST(%(recipients)s AS TEXT[])) AS rc(recipient) '
+                 'LEFT JOIN mail_sync_state AS st ON st.mailbox = %(mailbox)s '
+                 'AND st.recipient = rc.recipient')
+        result = self.query(query, {'mailbox': mailbox, 'recipients': list(recipients)})
+        return result[0]['last_sent']
+
+    def set_last_sent(self, mailbox, recipients, last_sent):
+        with self.transaction() as cursor:
+            execute_values(cursor, self.last_sent_upsert_query,
+                           [(mailbox, recipient, last_sent) for recipient in recipients])
+
+    def get_tenant_emails(self):
+        return [row['email'] for row in self.query('SELECT email FROM tenants')]
+
+    def insert_documents(self, emails):
+        '''Insert or refresh many retrieved emails in one statement, returns the count'''
+
+        # a row can only be upserted once per statement
+        unique_emails = {(email['Recipient'], email['Date sent']): email for email in emails}
+        rows = [dict(email, Attachments=Json(email['Attachments']) if email['Attachments'] else None)
+                for email in unique_emails.values()]
+        with self.transaction() as cursor:
+            execute_values(cursor, self.documents_batch_insert_query, rows,
+                           template=self.documents_batch_insert_template,
+                           page_size=self.documents_batch_size)
+        return len(unique_emails)
 
     def get_documents_by_email(self, email, attachments):
         # retrieves list of documents by email
+        # one row per attachment, in the order of the emails
         if attachments:
             query = ('SELECT * FROM doc_tenant_view WHERE "Recipient" = %(email)s '
-                     'AND "Attachments" IS NOT NULL ORDER BY "Date sent"')
+                     'AND "Attachment" IS NOT NULL '
+                     'ORDER BY "Date sent", "Document ID", "Attachment number"')
             results = self.query(query, {"email": email, 'attachments': attachments})
         else:
             query = ('SELECT * FROM doc_tenant_view WHERE "Recipient" = %(email)s '
-                     'ORDER BY "Date sent"')
+                     'ORDER BY "Date sent", "Document ID", "Attachment number"')
             results = self.query(query, {"email": email})
         return results if results else {}
 
+    def search_documents(self, query, recipient=None, date_range=None, after=None, limit=100):
+        '''Documents whose subject or attachment names match a search, best first
+
+        arguments:
+            query - words searched in the subjects, in web search syntax such
+                    as "security deposit" or deposit -inventory, and text
+                    searched in the attachment names
+            recipient - only search the documents sent to this address
+            date_range - (first, last) dates the documents were sent, both
+                         included, either can be None
+            after - (Rank, Document ID) of the last document of the previous
+                    page, None for the first page
+            limit - maximum number of documents returned
+
+        Returns rows of doc_tenant_view, one per attachment, with their Rank.
+        '''
+
+        query = query.strip()
+        if not query:
+            return []
+        first, last = date_range or (None, None)
+        after_rank, after_id = after or (None, None)
+        parameters = {'query': query, 'pattern': f'%{like_escape(query)}%',
+                      'attachment_rank': self.attachment_match_rank,
+                      'recipient': recipient, 'first': first, 'last': last,
+                      'after_rank': after_rank, 'after_id': after_id, 'limit': limit}
+        return self.query(self.search_documents_query, parameters)
+
     def get_properties_by_landlord(self):
-        query = ('SELECT "Landlord ID" AS "Landlord", COUNT("Property ID") '
-                 'AS "Number of properties" FROM prop_tenant_view '
-                 'GROUP BY "Landlord ID"')
+        query = ('SELECT ll_id AS "Landlord", properties AS "Number of properties" '
+                 'FROM landlord_stats ORDER BY ll_id')
         return self.query(query)
 
     def get_occupancy_by_building(self):
-        query = ('SELECT "Street", COUNT("Street") AS "Number of occupied properties", '
-                 'MIN("Number properties in building") AS "Total properties", '
-                 '100*ROUND(CAST(COUNT("Street") AS DECIMAL)/MIN("Number properties '
-                 'in building"), 2) AS "Occupancy (%)" FROM prop_tenant_view GROUP BY "Street"')
+        query = ('SELECT street AS "Street", occupied AS "Number of occupied properties", '
+                 'capacity AS "Total properties", '
+                 '100*ROUND(CAST(occupied AS DECIMAL)/NULLIF(capacity, 0), 2) '
+                 'AS "Occupancy (%)" FROM building_stats ORDER BY street')
         return self.query(query)
 
 
@@ -271,6 +746,30 @@ class CSVModel:
         else:
             self.filename = filename
 
+    def open(self, mode='r'):
+        '''Open the CSV file for reading or writing, gzip compressed if ending in .gz'''
+
+        if self.filename.lower().endswith('.gz'):
+            return gzip.open(self.filename, mode + 't', encoding='utf-8', newline='')
+        return open(self.filename, mode, encoding='utf-8', newline='')
+
+    def check_fields(self, fieldnames):
+        '''Raise an exception if fields are missing from the CSV header'''
+
+        missing_fields = set(self.fields.keys()) - set(fieldnames or [])
+        if len(missing_fields) > 0:
+            raise Exception(
+                f'''File is missing fields: {', '.join(missing_fields)}'''
+            )
+
+    def get_fieldnames(self):
+        '''Read in the CSV header only and return the list of field names'''
+
+        with self.open() as fh:
+            fieldnames = next(csv.reader(fh), [])
+        self.check_fields(fieldnames)
+        return fieldnames
+
     def get_all_records(self):
         '''Read in all records from the CSV and return a list'''
 
@@ -280,13 +779,8 @@ class CSVModel:
         with open(self.filename, 'r', encoding='utf-8') as fh:
             # turning fh into a list is necessary for our unit tests
             csvreader = csv.DictReader(list(fh.readlines()))
-            missing_fields = set(self.fields.keys()) - set(csvreader.fieldnames)
-            if len(missing_fields) > 0:
-                raise Exception(
-                    f'''File is missing fields: {', '.join(missing_fields)}'''
-                )
-            else:
-                return list(csvreader)
+            self.check_fields(csvreader.fieldnames)
+            return list(csvreader)
 
     def save_record(self, rows, keys):
         '''Save a dict of data to a CSV file'''
@@ -298,6 +792,66 @@ class CSVModel:
                 csvwriter.writerow(row)
 
 
+class AttachmentStore:
+    '''Attachment contents on disk, one file per distinct content
+
+    Files are named by the SHA-256 digest of their content, in a folder
+    named by its first two characters, so the same attachment sent to
+    many tenants is stored once.
+    '''
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        # partly written files, renamed into place once complete
+        self.tmp_path = os.path.join(self.path, 'tmp')
+        os.makedirs(self.tmp_path, exist_ok=True)
+
+    def content_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.content_path(digest))
+
+    def put(self, chunks):
+        '''Store the content given as an iterable of bytes, returns its digest
+
+        The content is hashed while written, and never held in memory whole.
+        '''
+
+        sha256 = hashlib.sha256()
+        fd, tmp_name = tempfile.mkstemp(dir=self.tmp_path)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    fh.write(chunk)
+            digest = sha256.hexdigest()
+            if digest in self:
+                os.remove(tmp_name)
+            else:
+                os.makedirs(os.path.dirname(self.content_path(digest)), exist_ok=True)
+                os.replace(tmp_name, self.content_path(digest))
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return digest
+
+    @contextmanager
+    def open(self, digest):
+        '''Memory-map the stored content for reading, yields a bytes-like object'''
+
+        with open(self.content_path(digest), 'rb') as fh:
+            # empty files can't be mapped
+            if os.fstat(fh.fileno()).st_size == 0:
+                yield b''
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                yield content
+
+
 class SettingsModel:
     '''A model for saving settings'''
 
@@ -306,9 +860,16 @@ class SettingsModel:
         'theme': {'type': 'str', 'value': 'aqua'},
         'db_host': {'type': 'str', 'value': 'localhost'},
         'db_name': {'type': 'str', 'value': 'housing_management'},
+        # database connection pool size
+        'db_pool_min': {'type': 'int', 'value': 1},
+        'db_pool_max': {'type': 'int', 'value': 5},
         'client_id': {'type': 'str', 'value': None},
         'client_secret': {'type': 'str', 'value': None},
         'account_email': {'type': 'str', 'value': None},
+        # folder keeping the attachment contents, empty to not download them
+        'attachment_store': {'type': 'str', 'value': ''},
+        # requests to the mail server at a time while retrieving emails
+        'mail_concurrency': {'type': 'int', 'value': 4},
     }
 
     def __init__(self, filename='settings.json', path='~'):
@@ -1,54 +1,434 @@
 from O365 import Account, FileSystemTokenBackend, MSGraphProtocol
+from requests.exceptions import HTTPError, RetryError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import math
+import mimetypes
+import os
 import re
+import shutil
+import threading
 
 
-class RetrieveSentDocuments():
-    '''Class for the retrieval of documents sent by email to tenants'''
+# fallback for recipients without an address field: the address ending
+# their text, as in 'Name <address>', 'Name (address)' or 'address'
+email_pattern = r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
+recipient_pattern = re.compile(rf'({email_pattern})[>)]?\s*$')
 
-    def __init__(self, settings):
-        self.settings = settings
-        self.emails = []
 
-        # create account with credentials, token and protocol
-        self.credentials = (self.settings['client_id'].get(),
-                            self.settings['client_secret'].get())
+def recipient_address(recipient):
+    '''Lower case email address of a message recipient, None if it has none'''
+
+    address = getattr(recipient, 'address', None)
+    if address is None:
+        found = recipient_pattern.search(str(recipient))
+        address = found.group(1) if found else None
+    return address.strip().lower() if address else None
+
+
+class SentMessagesQuery():
+    '''OData parameters for the Sent Items request, evaluated by the server'''
+
+    # attachment names only, the attachment content is never downloaded
+    # (the server expands at most 20 attachments per message)
+    expand = 'attachments($select=name,size,contentType)'
+
+    def __init__(self, recipient=None, since=None, until=None):
+        self.recipient = recipient
+        self.since = since
+        self.until = until
+
+    def as_params(self):
+        filters = []
+        if self.recipient:
+            recipient = self.recipient.replace("'", "''")
+            filters.append(f"toRecipients/any(r:r/emailAddress/address eq '{recipient}')")
+        if self.since:
+            since = self.since.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            filters.append(f'sentDateTime ge {since}')
+        if self.until:
+            until = self.until.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            filters.append(f'sentDateTime lt {until}')
+        params = {'$expand': self.expand}
+        if filters:
+            params['$filter'] = ' and '.join(filters)
+        return params
+
+
+class MailSession():
+    '''Authenticated connection to the Microsoft Outlook/Office365/Exchange account
+
+    Kept by the application across retrievals, so that the account, its
+    HTTP connection pool and the Sent folder are set up once.
+    '''
+
+    token_filename = 'o365_token.txt'
+    # access tokens are renewed this long before they expire
+    refresh_margin = timedelta(minutes=5)
+
+    def __init__(self, settings, token_path='.'):
+        '''Constructor for MailSession
+
+        arguments:
+            settings - dict of the settings variables
+            token_path - folder keeping the authentication token
+        '''
+        self.account_email = settings['account_email'].get()
+        self.credentials = (settings['client_id'].get(),
+                            settings['client_secret'].get())
+        # the settings this session was opened with
+        self.key = (self.account_email,) + self.credentials
+
+        # the token used to be kept in the current directory
+        token_path = os.path.expanduser(token_path)
+        token_file = os.path.join(token_path, self.token_filename)
+        if not os.path.exists(token_file) and os.path.exists(self.token_filename):
+            os.makedirs(token_path, exist_ok=True)
+            shutil.move(self.token_filename, token_file)
 
         # authenticated token and protocol
         protocol = MSGraphProtocol(api_version='beta')
-        token_backend = FileSystemTokenBackend(token_path='.',
-                                               token_filename='o365_token.txt')
+        token_backend = FileSystemTokenBackend(token_path=token_path,
+                                               token_filename=self.token_filename)
 
+        # no fixed pause between requests, throttling by the server is
+        # waited out by RetrieveSentDocuments.throttled()
         self.account = Account(self.credentials, token_backend=token_backend,
-                               protocol=protocol)
+                               protocol=protocol, requests_delay=0)
 
         # authentication step for account
         if not self.account.is_authenticated:
             self.account.authenticate(scopes=['basic'])
 
-    def get(self, tenant_email=None):
-        '''Retrieve sent emails from Microsoft Outlook/Office365/Exchange server'''
+        # the worker threads of a retrieval share the connection: one of them
+        # renews an expired token while the others wait and then use it
+        self.refresh_lock = threading.Lock()
+        self.connection_refresh = self.account.con.refresh_token
+        self.account.con.refresh_token = self.refresh_token
+
+        self.mailbox = self.account.mailbox(resource=self.account_email)
+        self.sent_folder = self.mailbox.sent_folder()
+
+    def authorization(self):
+        session = self.account.con.session
+        return session.headers.get('Authorization') if session is not None else None
+
+    def refresh_token(self):
+        '''Renew the access token, once for all the threads asking at the same time'''
+
+        authorization = self.authorization()
+        with self.refresh_lock:
+            # renewed by another thread while this one waited
+            if authorization is not None and self.authorization() != authorization:
+                return True
+            return self.connection_refresh()
+
+    def token_expiry(self):
+        '''Local time the access token expires, None if unknown'''
+
+        token_backend = self.account.con.token_backend
+        # O365 2.1 and later
+        if hasattr(token_backend, 'token_expiration_datetime'):
+            return token_backend.token_expiration_datetime()
+        token = getattr(token_backend, 'token', None)
+        return token.expiration_datetime if token else None
+
+    def refresh_if_expiring(self):
+        '''Renew the access token ahead of its expiry, so no request waits for it
+
+        Returns True if the token was renewed.
+        '''
+
+        if not self.account.is_authenticated:
+            return False
+        expiry = self.token_expiry()
+        # naive local times before O365 2.1, as now() without a timezone
+        if expiry is not None and datetime.now(expiry.tzinfo) + self.refresh_margin < expiry:
+            return False
+        return self.refresh_token()
+
+
+class RetrieveSentDocuments():
+    '''Class for the retrieval of documents sent by email to tenants'''
+
+    def __init__(self, session, store=None, concurrency=4):
+        '''Constructor for RetrieveSentDocuments
+
+        arguments:
+            session - MailSession of the account the emails were sent from
+            store - models.AttachmentStore keeping the attachment contents,
+                    None to only record their names
+            concurrency - most requests to the server at a time, the server
+                          itself allows 4 per mailbox
+        '''
+        self.session = session
+        self.account_email = session.account_email
+        self.store = store
+        self.concurrency = concurrency
+        self.emails = []
+        # digests of the attachments saved by earlier retrievals, by
+        # (recipient, date sent, position), not downloaded again
+        self.stored = {}
+
+    # messages requested per page from the server
+    batch_size = 100
+    # the Sent folder is split into this many time windows per request at
+    # a time, so a quiet window doesn't leave a request slot idle
+    windows_per_request = 4
+    # windows are never shorter than this, small incremental updates are
+    # fetched by a single request
+    min_window = timedelta(days=1)
+    # throttled requests (HTTP 429) are retried this many times, waiting as
+    # long as the server asks or else doubling the wait from throttle_backoff
+    throttle_retries = 5
+    throttle_backoff = 1
+
+    def get(self, tenant_email=None, since=None, progress=None, cancel=None):
+        '''Retrieve sent emails from Microsoft Outlook/Office365/Exchange server
+
+        arguments:
+            tenant_email - only retrieve emails sent to this address
+            since - only retrieve emails sent from this time onwards, for
+                    incremental updates (timezone-aware datetime)
+            progress - called as progress(scanned, matched) after every page
+            cancel - threading.Event stopping the retrieval when set
+        '''
+
+        query = SentMessagesQuery(recipient=tenant_email, since=since)
+        tenant = tenant_email.lower() if tenant_email else None
+        self.scan(query, lambda email: tenant_email if email == tenant else None,
+                  progress, cancel)
+
+    def get_all(self, tenant_emails, since=None, progress=None, cancel=None):
+        '''Retrieve sent emails to any of the tenants in one pass over the Sent folder
+
+        arguments:
+            tenant_emails - email addresses of all tenants
+            since, progress, cancel - as for get()
+        '''
+
+        # recipients are matched case-insensitively, records keep the tenant's spelling
+        tenants = {email.lower(): email for email in tenant_emails}
+        self.scan(SentMessagesQuery(since=since), tenants.get, progress, cancel)
+
+    def sync(self, data_model, tenant_emails, progress=None, cancel=None):
+        '''Retrieve the emails sent to the tenants since the previous sync and save them
+
+        arguments:
+            data_model - models.SQLModel the documents are saved to
+            tenant_emails - list of the tenants' email addresses
+            progress, cancel - as for get()
+
+        Returns the number of documents saved.
+        '''
+
+        # only emails sent since the previous retrieval are downloaded
+        since = data_model.get_last_sent(self.account_email, tenant_emails)
+        # and only attachments not stored yet
+        if self.store is not None:
+            self.stored = data_model.get_attachment_digests(
+                tenant_emails, since=self.saved_time(since) if since else None)
+        if len(tenant_emails) == 1:
+            self.get(tenant_email=tenant_emails[0], since=since,
+                     progress=progress, cancel=cancel)
+        else:
+            self.get_all(tenant_emails, since=since, progress=progress, cancel=cancel)
+        # all retrieved emails are saved in a single commit; only a complete
+        # scan tells which saved documents were deleted from the server
+        complete = since is None and not self.cancelled
+        with data_model.transaction():
+            inserted = data_model.insert_retrieved_documents(
+                self.emails, recipients=tenant_emails if complete else None)
+            # a cancelled scan may have skipped older emails, the sync time is kept
+            if self.last_sent is not None and not self.cancelled:
+                data_model.set_last_sent(self.account_email, tenant_emails, self.last_sent)
+        return inserted
+
+    def attachment_record(self, message, attachment, stored=None):
+        '''Name, size, content type and, once stored, content digest of an attachment
+
+        The content is downloaded unless stored, the digest saved by an
+        earlier retrieval, is still in the store.
+        '''
+
+        # O365 doesn't keep the content type sent by the server
+        content_type = (getattr(attachment, 'content_type', None)
+                        or mimetypes.guess_type(attachment.name or '')[0])
+        if self.store is None:
+            sha256 = None
+        elif stored is not None and stored in self.store:
+            sha256 = stored
+        else:
+            sha256 = self.download(message, attachment)
+        return {'name': attachment.name, 'size': attachment.size,
+                'content_type': content_type, 'sha256': sha256}
+
+    def saved_time(self, sent):
+        '''Sending time as saved with the documents: local time of the messages, no offset'''
+
+        return sent.astimezone(self.session.account.protocol.timezone).replace(tzinfo=None)
+
+    def download(self, message, attachment):
+        '''Stream the attachment content into the store, returns its digest'''
+
+        url = message.build_url(f'/messages/{message.object_id}/attachments/'
+                                f'{attachment.attachment_id}/$value')
+        response = self.throttled(lambda: message.con.get(url, stream=True))
+        try:
+            return self.store.put(response.iter_content(chunk_size=self.store.chunk_size))
+        finally:
+            response.close()
+
+    def sent_range(self, since=None):
+        '''Sending times of the oldest and newest emails in the Sent folder
+
+        Returns None if the folder is empty.
+        '''
+
+        # the server only sorts by properties filtered on first
+        query = SentMessagesQuery(since=since or datetime(1970, 1, 1, tzinfo=timezone.utc))
+        sent = []
+        for order in ('asc', 'desc'):
+            messages = self.throttled(lambda: self.session.sent_folder.get_messages(
+                limit=1, order_by=f'sentDateTime {order}', query=query))
+            message = next(iter(messages), None)
+            if message is None:
+                return None
+            sent.append(message.sent)
+        return tuple(sent)
+
+    def windows(self, query):
+        '''Split the query into consecutive sending time windows, newest first
+
+        The windows are listed in the order the server returns the Sent
+        folder, so the emails are kept in the same order as by one request.
+        '''
+
+        # the emails to one recipient are few enough for a single request
+        if self.concurrency <= 1 or query.recipient:
+            return [query]
+        sent = self.sent_range(query.since)
+        if sent is None:
+            return [query]
+        # the windows cover the emails there are, the last one is left open
+        # so that emails sent meanwhile are still seen
+        first, last = sent
+        span = last - first
+        count = min(self.concurrency * self.windows_per_request,
+                    math.ceil(span / self.min_window))
+        if count <= 1:
+            return [query]
+        bounds = [first + span * i / count for i in range(1, count)]
+        windows = [SentMessagesQuery(recipient=query.recipient, since=since, until=until)
+                   for since, until in zip([query.since] + bounds, bounds + [None])]
+        return windows[::-1]
+
+    def throttled(self, request, cancel=None):
+        '''Return request(), repeated after a wait while the server throttles
+
+        Returns None if cancel is set while waiting.
+        '''
+
+        for attempt in range(self.throttle_retries + 1):
+            try:
+                return request()
+            except (HTTPError, RetryError) as e:
+                response = getattr(e, 'response', None)
+                # RetryError: the connection's own retries ran out
+                if attempt == self.throttle_retries or (
+                        isinstance(e, HTTPError) and (response is None
+                                                      or response.status_code != 429)):
+                    raise
+                delay = self.throttle_backoff * 2 ** attempt
+                if response is not None and response.headers.get('Retry-After', '').isdigit():
+                    delay = int(response.headers['Retry-After'])
+                if (cancel or threading.Event()).wait(delay):
+                    return None
+
+    def scan(self, query, match, progress=None, cancel=None):
+        '''Walk the Sent folder once, keeping emails to the recipients found by match()
+
+        match() is given the lower case address of each recipient and returns
+        the address to record, or None to skip the recipient.
+
+        Time windows of the folder are fetched by up to concurrency requests
+        at a time, their emails are kept in window order.
+        '''
+
+        # latest sending time seen, the starting point of the next update
+        self.last_sent = query.since
+        self.scanned = 0
+        self.matched = 0
+        self.cancelled = False
+        self.lock = threading.Lock()
+        # set when a window fails, stopping the others
+        self.stop = threading.Event()
+
+        windows = self.windows(query)
+        if len(windows) == 1:
+            self.emails.extend(self.scan_window(windows[0], match, progress, cancel))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            found = []
+            try:
+                for window in windows:
+                    found.append(executor.submit(self.scan_window, window, match,
+                                                 progress, cancel))
+                for records in found:
+                    self.emails.extend(records.result())
+            except BaseException:
+                self.stop.set()
+                raise
+            finally:
+                # windows not started yet are dropped, the running ones see stop
+                for records in found:
+                    records.cancel()
+                executor.shutdown(wait=True)
+        if cancel is not None and cancel.is_set():
+            self.cancelled = True
+        if progress is not None:
+            progress(self.scanned, len(self.emails))
 
-        mailbox = self.account.mailbox(resource=self.settings['account_email'].get())
-        outbox = mailbox.sent_folder()
-        sent_messages = outbox.get_messages(download_attachments=True)
+    def scan_window(self, query, match, progress=None, cancel=None):
+        '''Emails of one time window to the recipients found by match(), in server order'''
 
-        # email pattern
-        name_str = r'[a-zA-Z\s]+'
-        email_str = r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+'
-        complete_str = '('+name_str+'|'+email_str+')\\s\\(('+email_str+')\\)'
-        pattern = re.compile(complete_str)
+        sent_folder = self.session.sent_folder
+        messages = self.throttled(lambda: sent_folder.get_messages(
+            limit=None, batch=self.batch_size, query=query), cancel)
 
-        for message in sent_messages:
-            for name_and_email in message.to._recipients:
-                email = pattern.sub(r'\2', str(name_and_email))
-                if tenant_email == email:
+        records = []
+        while messages is not None:
+            if self.stop.is_set() or (cancel is not None and cancel.is_set()):
+                break
+            # later pages are requested while iterating
+            message = self.throttled(lambda: next(messages, None), cancel)
+            if message is None:
+                break
+            # shared by all the recipients, so downloaded once per message
+            attachments = None
+            matched = 0
+            for recipient in message.to:
+                email = match(recipient_address(recipient))
+                if email is not None:
+                    if attachments is None and message.has_attachments:
+                        sent = self.saved_time(message.sent)
+                        attachments = [self.attachment_record(
+                                           message, attachment,
+                                           self.stored.get((email, sent, position)))
+                                       for position, attachment
+                                       in enumerate(message.attachments, 1)]
                     record = {}
                     record['Subject'] = message.subject
                     record['Recipient'] = email
                     record['Date sent'] = str(message.sent)
-                    if message.has_attachments:
-                        attachments = [attachment.name for attachment in message.attachments]
-                        record['Attachments'] = attachments
-                    else:
-                        record['Attachments'] = None
-                    self.emails.append(record)
+                    record['Attachments'] = attachments
+                    records.append(record)
+                    matched += 1
+            with self.lock:
+                self.scanned += 1
+                self.matched += matched
+                if self.last_sent is None or message.sent > self.last_sent:
+                    self.last_sent = message.sent
+                if progress is not None and self.scanned % self.batch_size == 0:
+                    progress(self.scanned, self.matched)
+        return records
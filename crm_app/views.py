@@ -1,15 +1,32 @@
 import tkinter as tk
+from collections import Counter
+from functools import lru_cache
 from tkinter import ttk
 from tkinter import messagebox
 from tkinter.simpledialog import Dialog
+from types import SimpleNamespace
 from . import widgets as w
-# matplotlib
-import numpy as np
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from matplotlib import use as mpl_use, pyplot as plt
-mpl_use('TkAgg')
-plt.style.use('ggplot')
+
+
+@lru_cache(maxsize=None)
+def plotting():
+    '''matplotlib and numpy, imported and styled on the first chart only
+
+    Loading the plotting stack takes longer than the rest of the
+    application startup, and most sessions never open a chart.
+    '''
+
+    import numpy as np
+    from matplotlib import use as mpl_use
+    mpl_use('TkAgg')
+    from matplotlib import pyplot as plt
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+    from matplotlib.collections import PolyCollection
+    plt.style.use('ggplot')
+    return SimpleNamespace(np=np, plt=plt, Figure=Figure, FigureCanvasTkAgg=FigureCanvasTkAgg,
+                           NavigationToolbar2Tk=NavigationToolbar2Tk,
+                           PolyCollection=PolyCollection)
 
 
 class MainMenu(tk.Menu):
@@ -48,6 +65,11 @@ class MainMenu(tk.Menu):
             label='Export file with tenant data'+chr(8230),
             command=callbacks['file->export']
             )
+        file_menu.add_separator()
+        file_menu.add_command(
+            label='Retrieve emails sent to all tenants',
+            command=callbacks['file->retrieve_all_emails']
+            )
         self.add_cascade(label='File', menu=file_menu)
         file_menu.add_separator()
         stats_menu = tk.Menu(file_menu, tearoff=False)
@@ -319,7 +341,7 @@ class DocumentList(tk.Frame):
         'Recipient': {'label': 'Recipient', 'width': 220},
         'Date sent': {'label': 'Date sent', 'width': 180},
         'Date retrieved': {'label': 'Date retrieved', 'width': 180},
-        'Attachments': {'label': 'Attachments', 'width': 260},
+        'Attachment': {'label': 'Attachment', 'width': 260},
     }
     default_width = 100
     default_minwidth = 20
@@ -360,11 +382,30 @@ class DocumentList(tk.Frame):
                                           input_class=ttk.Button,
                                           input_var=self.callbacks['on_retrieve_emails'])
         self.refreshbutton.grid(row=0, column=1, padx=10, pady=(10, 0), sticky=tk.W)
+        # add cancel button for the running retrieval
+        self.cancelbutton = w.LabelInput(commandinfo, 'Cancel retrieval',
+                                         input_class=ttk.Button,
+                                         input_var=self.callbacks['on_cancel_retrieval'])
+        self.cancelbutton.grid(row=0, column=2, padx=10, pady=(10, 0), sticky=tk.W)
         # add checkbutton option for files with/without attachment
         self.attachmentoption = w.LabelInput(commandinfo, 'Select only email(s) with attachments',
                                              input_class=ttk.Checkbutton,
                                              input_var=self.input_var)
-        self.attachmentoption.grid(row=0, column=2, padx=10, pady=(10, 0), sticky=tk.W)
+        self.attachmentoption.grid(row=0, column=3, padx=10, pady=(10, 0), sticky=tk.W)
+        # search of the subjects and attachment names
+        self.search = w.LabelInput(commandinfo, 'Search subjects and attachments',
+                                   input_class=ttk.Entry, input_var=tk.StringVar())
+        self.search.grid(row=1, column=0, columnspan=2, padx=10, pady=(10, 0))
+        self.search.input.bind('<Return>', lambda event: self.callbacks['on_search_documents']())
+        self.searchbutton = w.LabelInput(commandinfo, 'Search',
+                                         input_class=ttk.Button,
+                                         input_var=self.callbacks['on_search_documents'])
+        self.searchbutton.grid(row=1, column=2, padx=10, pady=(10, 0), sticky=tk.W)
+        self.morebutton = w.LabelInput(commandinfo, 'More results',
+                                       input_class=ttk.Button,
+                                       input_var=self.callbacks['on_more_search_results'])
+        self.morebutton.grid(row=1, column=3, padx=10, pady=(10, 0), sticky=tk.W)
+        self.morebutton.input.state(['disabled'])
         commandinfo.grid(row=1, column=0, columnspan=2, sticky=(tk.W + tk.E))
 
         # configure treeview columns
@@ -378,43 +419,42 @@ class DocumentList(tk.Frame):
             self.treeview.column(name, anchor=anchor, minwidth=minwidth,
                                  width=width, stretch=stretch)
 
-    def populate(self, rows):
-        '''Clear the treeview and write the supplied data rows to it'''
+    def populate(self, rows, append=False):
+        '''Clear the treeview and write the supplied data rows to it
+
+        arguments:
+            rows - rows of doc_tenant_view, one per attachment
+            append - add the rows after those listed, for the next page
+                     of search results
+        '''
 
-        for row in self.treeview.get_children():
-            self.treeview.delete(row)
+        if not append:
+            for row in self.treeview.get_children():
+                self.treeview.delete(row)
 
         # create striped row tags
         self.treeview.tag_configure('oddrow', background='white')
         self.treeview.tag_configure('evenrow', background='lightblue')
 
         valuekeys = list(self.column_defs.keys())[1:]
+        # rows come one per attachment, emails with several are highlighted
+        attachment_counts = Counter(rowdata['Document ID'] for rowdata in rows
+                                    if rowdata['Attachment'] is not None)
         row_count = 0
         for rowdata in rows:
-            # if there are no attachments in the sent email
-            att = rowdata['Attachments']
-            split_attachments = att[1:-1].split(',') if isinstance(att, str) else None
-            rowkey = (str(rowdata['Subject']), str(rowdata['Recipient']),
-                      str(rowdata['Date sent']), str(rowdata['Date retrieved']),
-                      str(rowdata['Attachments']))
+            stringkey = '{}|{}'.format(rowdata['Document ID'], rowdata['Attachment number'])
             values = [rowdata[key] for key in valuekeys]
-            stringkey = '{}|{}|{}|{}|{}'.format(*rowkey)
-            if split_attachments is None:
-                self.treeview.insert('', 'end', iid=stringkey, text=stringkey, values=values)
-                row_count += 1
-            # for email with one or more attachments
-            else:
-                for attach in split_attachments:
-                    rowkey = (str(rowdata['Subject']), str(rowdata['Recipient']),
-                              str(rowdata['Date sent']), str(attach))
-                    stringkey = '{}|{}|{}|{}'.format(*rowkey)
-                    values = [rowdata[key] for key in valuekeys[:-1]] + [attach]
-                    if len(split_attachments) > 1:
-                        self.treeview.insert('', 'end', iid=stringkey, text=stringkey, values=values, tags=('evenrow',))
-                    else:
-                        self.treeview.insert('', 'end', iid=stringkey, text=stringkey, values=values, tags=('oddrow',))
-                    row_count += 1
-        self.count = row_count
+            count = attachment_counts[rowdata['Document ID']]
+            tags = ('evenrow',) if count > 1 else ('oddrow',) if count else ()
+            self.treeview.insert('', 'end', iid=stringkey, text=stringkey, values=values,
+                                 tags=tags)
+            row_count += 1
+        self.count = self.count + row_count if append else row_count
+
+    def show_more_results(self, more):
+        '''Enable the button loading the next page of search results'''
+
+        self.morebutton.input.state(['!disabled' if more else 'disabled'])
 
     def save_documentlist_to_file(self):
         '''Appends records from the document table to a Python list'''
@@ -427,7 +467,11 @@ class DocumentList(tk.Frame):
 
 
 class RecordList(tk.Frame):
-    '''Display records in the database'''
+    '''Display records in the database
+
+    The rows are kept in a Python list and only the rows in view exist as
+    treeview items, these are replaced when the list is scrolled.
+    '''
 
     column_defs = {
         '#0': {'label': 'Row', 'anchor': tk.W},
@@ -446,6 +490,12 @@ class RecordList(tk.Frame):
     default_width = 100
     default_minwidth = 20
     default_anchor = tk.W
+    # number of rows shown, and of treeview items created
+    visible_rows = 10
+    # rows moved by one mouse wheel step
+    wheel_rows = 3
+    # choices of the tenant filter
+    tenant_filter_values = {'': None, 'Occupied': True, 'Vacant': False}
 
     def __init__(self, parent, callbacks,
                  inserted, updated,
@@ -457,9 +507,28 @@ class RecordList(tk.Frame):
         self.columnconfigure(0, weight=1)
         self.rowconfigure(0, weight=1)
 
+        # all rows as tuples of column values, with their row tag
+        self.rows = []
+        self.row_tags = []
+        self.row_index = {}
+        # index of the first row in view, and Property ID of the selected row
+        self.offset = 0
+        self.selected_id = None
+        # set while render() selects the selected row again
+        self.reselecting = False
+        # rows are loaded a page at a time, until the last page is loaded
+        self.complete = True
+        self.loading = False
+        self.sort_column = 'Property ID'
+        self.sort_descending = False
+        # filters and sort order the loaded rows were queried with, the
+        # later pages are loaded with it whatever the filter bar shows since
+        self.query = {'filters': {}, 'sort_column': self.sort_column,
+                      'descending': self.sort_descending}
+
         # create treeview
         self.treeview = ttk.Treeview(self, columns=list(self.column_defs.keys())[1:],
-                                     selectmode='browse')
+                                     selectmode='browse', height=self.visible_rows)
         self.columnconfigure(0, weight=1)
         self.rowconfigure(0, weight=1)
         self.treeview.grid(row=0, column=0, sticky='NSEW')
@@ -467,10 +536,9 @@ class RecordList(tk.Frame):
         # hide first column
         self.treeview.config(show='headings')
 
-        # configure scrollbar for the treeview
+        # configure scrollbar, which moves through the rows rather than the treeview
         self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL,
-                                       command=self.treeview.yview)
-        self.treeview.configure(yscrollcommand=self.scrollbar.set)
+                                       command=self.yview)
         self.treeview.grid(row=0, column=0, sticky='NSEW')
         self.scrollbar.grid(row=0, column=1, sticky='NSEW')
 
@@ -484,6 +552,40 @@ class RecordList(tk.Frame):
             self.treeview.heading(name, text=label, anchor=anchor)
             self.treeview.column(name, anchor=anchor, minwidth=minwidth,
                                  width=width, stretch=stretch)
+            # sort on heading click
+            if name != '#0':
+                self.treeview.heading(name, command=lambda name=name: self.sort_by(name))
+        self.show_sort_order()
+
+        # filter bar, the filters apply on the database query
+        filterinfo = tk.LabelFrame(self, text='Filter records', padx=5, pady=5)
+        self.filters = {}
+        for column, key in enumerate(('Landlord ID', 'Street', 'Post code', 'City')):
+            self.filters[key] = w.LabelInput(filterinfo, key, input_class=ttk.Entry,
+                                             input_var=tk.StringVar())
+            self.filters[key].grid(row=0, column=column)
+        self.filters['Name'] = w.LabelInput(filterinfo, 'Tenant name starts with',
+                                            input_class=ttk.Entry, input_var=tk.StringVar())
+        self.filters['Name'].grid(row=1, column=0)
+        self.filters['Email'] = w.LabelInput(filterinfo, 'Tenant email starts with',
+                                             input_class=ttk.Entry, input_var=tk.StringVar())
+        self.filters['Email'].grid(row=1, column=1)
+        self.filters['Tenant'] = w.LabelInput(filterinfo, 'Tenant',
+                                              input_class=ttk.Combobox, input_var=tk.StringVar(),
+                                              input_args={'values': list(self.tenant_filter_values),
+                                                          'state': 'readonly'})
+        self.filters['Tenant'].grid(row=1, column=2)
+        for widget in self.filters.values():
+            widget.input.bind('<Return>', lambda event: self.callbacks['on_filter_records']())
+        self.filterbutton = w.LabelInput(filterinfo, 'Apply filter',
+                                         input_class=ttk.Button,
+                                         input_var=self.callbacks['on_filter_records'])
+        self.filterbutton.grid(row=0, column=4, padx=10, pady=(10, 0))
+        self.clearbutton = w.LabelInput(filterinfo, 'Clear filter',
+                                        input_class=ttk.Button,
+                                        input_var=self.clear_filters)
+        self.clearbutton.grid(row=1, column=4, padx=10, pady=(10, 0))
+        filterinfo.grid(row=1, column=0, columnspan=2, sticky=(tk.W + tk.E))
 
         # configure row tags
         self.treeview.tag_configure('inserted_tenant', background='lightgreen')
@@ -493,89 +595,459 @@ class RecordList(tk.Frame):
         # bind selection
         self.treeview.bind('<<TreeviewSelect>>', self.on_open_record)
 
+        # scrolling past the rows in view
+        self.treeview.bind('<Up>', lambda event: self.move_selection(-1))
+        self.treeview.bind('<Down>', lambda event: self.move_selection(1))
+        self.treeview.bind('<Prior>', lambda event: self.move_selection(-self.visible_rows))
+        self.treeview.bind('<Next>', lambda event: self.move_selection(self.visible_rows))
+        self.treeview.bind('<Home>', lambda event: self.move_selection(-len(self.rows)))
+        self.treeview.bind('<End>', lambda event: self.move_selection(len(self.rows)))
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.treeview.bind(sequence, self.on_mousewheel)
+
     def on_open_record(self, *args):
-        try:
-            selected_id = self.treeview.selection()[0]
-            self.callbacks['on_open_record'](selected_id.split('|')[0])
-        # quick fix when window loses focus and no line is selected,
-        # a better fix is to find a way to keep the line selected
-        except IndexError:
-            pass
+        selection = self.treeview.selection()
+        # no line is selected when the window loses focus
+        if not selection:
+            return
+        # clicking the selected row reloads the record, discarding the form
+        # edits; selecting it again when the rows in view are replaced doesn't
+        if self.reselecting and selection[0] == self.selected_id:
+            return
+        self.selected_id = selection[0]
+        self.callbacks['on_open_record'](self.selected_id)
+
+    def row_values(self, rowdata, inserted, updated):
+        '''Column values of a data row and the tag highlighting recent changes'''
 
-    def populate(self, rows):
-        '''Clear the treeview and write the supplied data rows to it'''
+        valuekeys = list(self.column_defs.keys())[1:]
+        values = tuple(rowdata[key] for key in valuekeys)
+        rowkey_pr = (str(rowdata['Property ID']), str(rowdata['Landlord ID']),
+                     str(rowdata['Flat number']),
+                     str(rowdata['Street']),
+                     str(rowdata['Post code']), str(rowdata['City']))
+        rowkey_tn = (str(rowdata['Property ID']), str(rowdata['First name']),
+                     str(rowdata['Last name']), str(rowdata['Email']))
+        if rowkey_tn in inserted:
+            tag = 'inserted_tenant'
+        elif rowkey_tn in updated:
+            tag = 'updated_tenant'
+        elif rowkey_pr in inserted:
+            tag = 'inserted_property'
+        else:
+            tag = ''
+        return values, tag
+
+    def get_query(self):
+        '''Filters and sort order of the records to load'''
+
+        filters = {key: widget.get().strip() for key, widget in self.filters.items()}
+        filters['Tenant'] = self.tenant_filter_values.get(filters['Tenant'])
+        return {'filters': filters, 'sort_column': self.sort_column,
+                'descending': self.sort_descending}
+
+    def clear_filters(self):
+        for widget in self.filters.values():
+            widget.set('')
+        self.callbacks['on_filter_records']()
 
-        for row in self.treeview.get_children():
-            self.treeview.delete(row)
+    def sort_by(self, column):
+        '''Reload the records sorted by column, reversing the order on a second click'''
 
-        valuekeys = list(self.column_defs.keys())[1:]
+        if column == self.sort_column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column = column
+            self.sort_descending = False
+        self.show_sort_order()
+        self.callbacks['on_filter_records']()
+
+    def show_sort_order(self):
+        for name, definition in list(self.column_defs.items())[1:]:
+            label = definition.get('label', '')
+            if name == self.sort_column:
+                # 9660 / 9650: down / up pointing triangles
+                label += ' ' + chr(9660 if self.sort_descending else 9650)
+            self.treeview.heading(name, text=label)
+
+    def sort_key(self, values):
+        column = self.query['sort_column']
+        value = values[list(self.column_defs.keys()).index(column) - 1]
+        return ('' if value is None else value, values[0])
+
+    def last_key(self):
+        '''Sort value and Property ID of the last loaded row, where the next page starts'''
+
+        return self.sort_key(self.rows[-1]) if self.rows else None
+
+    def populate(self, rows, query, complete=True):
+        '''Replace the stored rows with the supplied data rows and show the first ones
+
+        query is the get_query() result the rows were loaded with, complete
+        is False when more rows can be loaded after these.
+        '''
+
+        self.query = query
+
+        inserted = set(self.inserted)
+        updated = set(self.updated)
+        self.rows = []
+        self.row_tags = []
         for rowdata in rows:
-            rowkey_pr = (str(rowdata['Property ID']), str(rowdata['Landlord ID']),
-                         str(rowdata['Number properties in building']),
-                         str(rowdata['Flat number']),
-                         str(rowdata['Street']),
-                         str(rowdata['Post code']), str(rowdata['City']))
-            rowkey_tn = (str(rowdata['Property ID']), str(rowdata['First name']),
-                         str(rowdata['Last name']), str(rowdata['Email']))
-            rowkey = rowkey_pr + rowkey_tn
-            values = [rowdata[key] for key in valuekeys]
-            if self.inserted and rowkey_tn in self.inserted:
-                tag = 'inserted_tenant'
-            elif self.updated and rowkey_tn in self.updated:
-                tag = 'updated_tenant'
-            elif self.inserted and rowkey_pr in self.inserted:
-                tag = 'inserted_property'
-            else:
-                tag = ''
-            stringkey = '{}|{}|{}|{}|{}|{}|{}|{}|{}|{}'.format(*rowkey)
-            self.treeview.insert('', 'end', iid=stringkey, text=stringkey,
-                                 values=values, tag=tag)
+            values, tag = self.row_values(rowdata, inserted, updated)
+            self.rows.append(values)
+            self.row_tags.append(tag)
+        self.index_rows()
+        self.complete = complete
+
+        self.offset = 0
+        self.selected_id = None
+        self.render()
 
         # selects automatically the first row, to make selections keyboard-friendly
-        if len(rows) > 0:
-            firstrow = self.treeview.identify_row(0)
+        if len(self.rows) > 0:
+            firstrow = self.rows[0][0]
             self.treeview.focus_set()
             self.treeview.selection_set(firstrow)
             self.treeview.focus(firstrow)
 
+    def append(self, rows, complete=True):
+        '''Add the next page of data rows after the loaded rows'''
+
+        inserted = set(self.inserted)
+        updated = set(self.updated)
+        for rowdata in rows:
+            values, tag = self.row_values(rowdata, inserted, updated)
+            # already loaded, as a row added or edited since the first page
+            if values[0] in self.row_index:
+                continue
+            self.row_index[values[0]] = len(self.rows)
+            self.rows.append(values)
+            self.row_tags.append(tag)
+        self.complete = complete
+        self.render()
+
+    def index_rows(self):
+        # position of each property in the stored rows
+        self.row_index = {values[0]: index for index, values in enumerate(self.rows)}
+
+    def update_row(self, rowdata):
+        '''Insert or replace the row of a single property, leaving the other rows as they are'''
+
+        values, tag = self.row_values(rowdata, set(self.inserted), set(self.updated))
+        # an edited row stays where it is, even if its sort value changed
+        index = self.row_index.get(values[0])
+        if index is not None:
+            self.rows[index] = values
+            self.row_tags[index] = tag
+            self.render()
+            return
+
+        # only Property IDs sort alike in Python and in the database
+        # collation, a new row is otherwise shown first in view
+        if self.query['sort_column'] == 'Property ID':
+            if self.query['descending']:
+                index = next((index for index, row in enumerate(self.rows)
+                              if row[0] < values[0]), len(self.rows))
+            else:
+                index = next((index for index, row in enumerate(self.rows)
+                              if row[0] > values[0]), len(self.rows))
+            # a row after the loaded rows comes with a later page
+            if index == len(self.rows) and not self.complete:
+                return
+        else:
+            index = self.offset
+        self.rows.insert(index, values)
+        self.row_tags.insert(index, tag)
+        self.index_rows()
+        self.render()
+
+    def delete_row(self, prop_id):
+        '''Remove the row of a single property'''
+
+        index = self.row_index.get(prop_id)
+        if index is None:
+            return
+        del self.rows[index]
+        del self.row_tags[index]
+        self.index_rows()
+        if self.selected_id == prop_id:
+            self.selected_id = None
+        # keeps the window of rows in view within the remaining rows
+        self.offset = max(0, min(self.offset, len(self.rows) - self.visible_rows))
+        self.render()
+
+    def render(self):
+        '''Create the treeview items for the rows in view'''
+
+        self.treeview.delete(*self.treeview.get_children())
+        end = self.offset + self.visible_rows
+        for values, tag in zip(self.rows[self.offset:end], self.row_tags[self.offset:end]):
+            self.treeview.insert('', 'end', iid=values[0], values=values, tag=tag)
+
+        if self.selected_id is not None and self.treeview.exists(self.selected_id):
+            # the selection events are queued, and handled before idle callbacks
+            self.reselecting = True
+            self.treeview.selection_set(self.selected_id)
+            self.treeview.focus(self.selected_id)
+            self.after_idle(self.end_reselecting)
+
+        total = len(self.rows)
+        if total > 0:
+            self.scrollbar.set(self.offset / total, min(end, total) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+        # load the next page once the last page of loaded rows comes into view
+        if not self.complete and not self.loading and end + self.visible_rows >= total:
+            self.loading = True
+            try:
+                self.callbacks['on_more_records']()
+            finally:
+                self.loading = False
+
+    def end_reselecting(self):
+        self.reselecting = False
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, len(self.rows) - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def yview(self, *args):
+        '''Scrollbar command, see the yview method of Tk widgets'''
+
+        if args[0] == 'moveto':
+            self.scroll_to(round(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            step = self.visible_rows if args[2] == 'pages' else 1
+            self.scroll_to(self.offset + int(args[1]) * step)
+
+    def on_mousewheel(self, event):
+        # X11 reports the wheel as buttons 4 and 5, the others as a delta
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.offset - self.wheel_rows)
+        else:
+            self.scroll_to(self.offset + self.wheel_rows)
+        return 'break'
+
+    def move_selection(self, step):
+        '''Move the selection by step rows, scrolling the selected row into view'''
+
+        if not self.rows:
+            return 'break'
+        selection = self.treeview.selection()
+        if selection:
+            index = self.offset + self.treeview.index(selection[0])
+        else:
+            index = self.offset
+        index = max(0, min(index + step, len(self.rows) - 1))
+        if index < self.offset:
+            self.scroll_to(index)
+        elif index >= self.offset + self.visible_rows:
+            self.scroll_to(index - self.visible_rows + 1)
+        row_id = self.rows[index][0]
+        self.treeview.selection_set(row_id)
+        self.treeview.focus(row_id)
+        return 'break'
+
 
 class BarChartView(tk.Frame):
-    '''Graphical plots showing some statistics on occupancy'''
+    '''Graphical plots showing some statistics on occupancy
+
+    Groups are sorted by decreasing value and shown a page at a time, or
+    as the largest groups followed by an 'Other' bar summing the rest.
+    The bars and their labels are created once and redrawn over a cached
+    background when the page changes, the axes are only redrawn when the
+    vertical scale changes.
+    '''
+
+    # bars shown at a time
+    page_size = 20
+    bar_width = 0.8
 
     def __init__(self, parent, x_axis, y_axis, title):
         super().__init__(parent)
-        self.figure = Figure(figsize=(8, 6), dpi=100, layout='tight')
-        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
-        self.toolbar = NavigationToolbar2Tk(self.canvas, self)
+        self.plot = plotting()
+        np = self.plot.np
+        self.figure = self.plot.Figure(figsize=(8, 6), dpi=100)
+        # fixed margins, the labels below the axes are drawn separately
+        self.figure.subplots_adjust(left=0.12, right=0.97, top=0.92, bottom=0.3)
+        self.canvas = self.plot.FigureCanvasTkAgg(self.figure, master=self)
+        self.toolbar = self.plot.NavigationToolbar2Tk(self.canvas, self)
+
+        # paging through the groups
+        controls = tk.Frame(self)
+        self.previous_button = ttk.Button(controls, text='< Previous',
+                                          command=lambda: self.show_page(self.page - 1))
+        self.previous_button.pack(side='left')
+        self.next_button = ttk.Button(controls, text='Next >',
+                                      command=lambda: self.show_page(self.page + 1))
+        self.next_button.pack(side='left')
+        self.page_status = tk.StringVar()
+        ttk.Label(controls, textvariable=self.page_status).pack(side='left', padx=10)
+        self.top_groups = tk.BooleanVar()
+        ttk.Checkbutton(controls, text="Largest groups, rest as 'Other'",
+                        variable=self.top_groups,
+                        command=self.on_top_groups).pack(side='right')
+        controls.pack(fill='x')
         self.canvas.get_tk_widget().pack(fill='both', expand=True)
+
         # axes
         self.axes = self.figure.add_subplot(1, 1, 1)
-        self.axes.set_xlabel(x_axis, fontsize=14)
+        self.axes.set_xlabel(x_axis, fontsize=14, labelpad=90)
         self.axes.set_ylabel(y_axis, fontsize=14)
         self.axes.set_title(title, fontsize=16)
+        self.axes.set_xlim(-0.5, self.page_size - 0.5)
+        self.axes.set_xticks([])
+        self.axes.tick_params(axis='y', labelsize=14)
+
+        # bars, the part of the buildings still vacant and the group labels,
+        # left out of full redraws and drawn over the background instead
+        self.slots = np.arange(self.page_size)
+        self.colors = self.plot.plt.cm.Paired(self.slots % self.plot.plt.cm.Paired.N)
+        self.bars = self.plot.PolyCollection([], edgecolor='k', alpha=0.8, animated=True)
+        self.tops = self.plot.PolyCollection([], edgecolor='k', alpha=0.4, animated=True)
+        self.axes.add_collection(self.bars)
+        self.axes.add_collection(self.tops)
+        self.labels = [self.axes.text(slot, -0.02, '', transform=self.axes.get_xaxis_transform(),
+                                      ha='right', va='top', rotation=45, rotation_mode='anchor',
+                                      fontsize=10, animated=True)
+                       for slot in self.slots]
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        # the toolbar saves through figure.savefig, a full draw
+        self.saving = False
+        self.figure_savefig = self.figure.savefig
+        self.figure.savefig = self.save_figure
+
+        self.group_names = np.array([], dtype=object)
+        self.values = np.zeros((1, 0))
+        self.page = 0
 
     def draw_bar_chart(self, data):
-        labels, prime_values, *secondary_values = zip(*data)
-        self.bar = self.axes.bar(labels, prime_values, color=plt.cm.Paired.colors,
-                                 edgecolor='k', label=labels, alpha=0.8)
-        self.axes.legend(self.bar, labels)
-        if secondary_values:
-            top_values = np.array(secondary_values[0])-np.array(prime_values)
-            self.bar = self.axes.bar(labels, top_values, bottom=prime_values,
-                                     color=plt.cm.Paired.colors, edgecolor='k',
-                                     label=labels, alpha=0.4)
-            self.axes.legend(self.bar, [])
-            text_loc = float(self.axes.yaxis.get_data_interval()[1])
-            self.axes.set_ylim([0, text_loc+3])
-            # annotate labels
-            occupancy_values = [int(x) for x in secondary_values[1]]
-            for x, y in zip(labels, occupancy_values):
-                self.axes.annotate('{0:d}%'.format(y), xy=(x, text_loc+1.5),
-                                   ha='center', size=12, color='k')
-        plt.setp(self.axes.get_xticklabels(), ha="right",
-                 rotation_mode="anchor",
-                 rotation=45, fontsize=14)
-        plt.setp(self.axes.get_yticklabels(), fontsize=14)
+        '''Show the rows of data, (label, value) or, for stacked bars,
+        (label, value, total, percentage annotated below the label)'''
+
+        np = self.plot.np
+        labels, *values = zip(*data) if data else ((), ())
+        values = np.array(values, dtype=float).reshape(len(values), len(labels))
+        order = np.argsort(-values[0], kind='stable')
+        self.group_names = np.array(labels, dtype=object)[order]
+        self.values = values[:, order]
+        self.show_page(0)
+        self.rescale()
+
+    def on_top_groups(self):
+        self.show_page(0)
+        self.rescale()
+
+    def page_groups(self):
+        '''Names and values of the groups of the current page'''
+
+        np = self.plot.np
+        if self.top_groups.get() and len(self.group_names) > self.page_size:
+            head = self.page_size - 1
+            other = self.values[:, head:].sum(axis=1)
+            if len(other) == 3:
+                other[2] = 100 * other[0] / other[1] if other[1] else np.nan
+            names = np.append(self.group_names[:head], 'Other')
+            return names, np.column_stack([self.values[:, :head], other])
+        start = self.page * self.page_size
+        end = start + self.page_size
+        return self.group_names[start:end], self.values[:, start:end]
+
+    def bar_verts(self, slots, bottom, top):
+        '''Corners of one rectangle per slot, as an array of shape (slots, 4, 2)'''
+
+        np = self.plot.np
+        left = slots - self.bar_width / 2
+        right = slots + self.bar_width / 2
+        return np.stack([np.column_stack([left, bottom]), np.column_stack([left, top]),
+                         np.column_stack([right, top]), np.column_stack([right, bottom])],
+                        axis=1)
+
+    def show_page(self, page):
+        np = self.plot.np
+        pages = max(1, -(-len(self.group_names) // self.page_size))
+        self.page = min(max(page, 0), pages - 1)
+        names, values = self.page_groups()
+        slots = self.slots[:len(names)]
+
+        self.bars.set_verts(self.bar_verts(slots, np.zeros(len(slots)), values[0]))
+        self.bars.set_facecolor(self.colors[:len(slots)])
+        if len(values) > 1:
+            self.tops.set_verts(self.bar_verts(slots, values[0], values[1]))
+            self.tops.set_facecolor(self.colors[:len(slots)])
+            texts = [f'{name} ({percent:.0f}%)' if not np.isnan(percent) else str(name)
+                     for name, percent in zip(names, values[2])]
+        else:
+            texts = [str(name) for name in names]
+        for label, text in zip(self.labels, texts + [''] * (self.page_size - len(texts))):
+            label.set_text(text)
+
+        paging = not self.top_groups.get() or len(self.group_names) <= self.page_size
+        self.previous_button.state(['!disabled' if paging and self.page > 0 else 'disabled'])
+        self.next_button.state(['!disabled' if paging and self.page < pages - 1 else 'disabled'])
+        if paging:
+            start = self.page * self.page_size
+            self.page_status.set(f'{min(start + 1, len(self.group_names))}-'
+                                 f'{start + len(names)} of {len(self.group_names)}')
+        else:
+            self.page_status.set(f'{len(self.group_names)} groups')
+        self.blit()
+
+    def rescale(self):
+        '''Fit the vertical axis to the tallest bar of any page, a full redraw'''
+
+        if self.top_groups.get() and len(self.group_names) > self.page_size:
+            tallest = self.page_groups()[1][:2].max(initial=0)
+        else:
+            tallest = self.values[:2].max(initial=0)
+        self.axes.set_ylim(0, 1.05 * tallest or 1)
+        self.background = None
+        self.canvas.draw_idle()
+
+    def on_draw(self, event):
+        # a full redraw, on showing, resizing or a new scale, leaves out
+        # the animated artists: keep it as the background of later pages
+        if self.saving:
+            return
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
+
+    def save_figure(self, *args, **kwargs):
+        '''Figure.savefig with the bars and labels drawn as other artists'''
+
+        artists = [self.bars, self.tops] + self.labels
+        for artist in artists:
+            artist.set_animated(False)
+        self.saving = True
+        try:
+            return self.figure_savefig(*args, **kwargs)
+        finally:
+            for artist in artists:
+                artist.set_animated(True)
+            self.saving = False
+            # saving may have drawn over the screen buffer
+            self.background = None
+            self.canvas.draw_idle()
+
+    def draw_animated(self):
+        self.axes.draw_artist(self.bars)
+        self.axes.draw_artist(self.tops)
+        for label in self.labels:
+            self.axes.draw_artist(label)
+
+    def blit(self):
+        if self.background is None:
+            # no background yet, the pending full redraw draws the bars
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.figure.bbox)
 
 
 class LoginDialog(Dialog):
@@ -1,6 +1,10 @@
 -- lookup tables:
 --   landlords
 --   properties
+--   tenants
+--   documents
+-- written with IF NOT EXISTS so that databases created before schema
+-- versioning are adopted as they are
 
 CREATE TABLE IF NOT EXISTS landlords (
     ll_id VARCHAR(6) UNIQUE NOT NULL,
@@ -10,6 +14,7 @@ CREATE TABLE IF NOT EXISTS landlords (
 CREATE TABLE IF NOT EXISTS properties (
     prop_id VARCHAR(7) UNIQUE NOT NULL,
     ll_id VARCHAR(6) NOT NULL REFERENCES landlords(ll_id) ON DELETE CASCADE ON UPDATE CASCADE,
+    num_prop_building INT NOT NULL,
     flat_num VARCHAR(3) NOT NULL,
     street VARCHAR(60) NOT NULL,
     post_code VARCHAR(10) NOT NULL,
@@ -25,18 +30,45 @@ CREATE TABLE IF NOT EXISTS tenants (
     PRIMARY KEY(email)
     );
 
+-- one tenant per property, target of the tenant upserts; a database
+-- from before may list several tenants for a property, which only the
+-- user can choose between
+DO $$
+DECLARE
+    duplicates TEXT;
+BEGIN
+    SELECT string_agg(prop_id || ' (' || tenants || ')', ', ' ORDER BY prop_id) INTO duplicates
+        FROM (SELECT prop_id, string_agg(email, ', ' ORDER BY email) AS tenants
+              FROM tenants GROUP BY prop_id HAVING COUNT(*) > 1) AS shared;
+    IF duplicates IS NOT NULL THEN
+        RAISE EXCEPTION 'properties with more than one tenant: %', duplicates
+            USING HINT = 'Delete all but one tenant of each of these properties, then start again.';
+    END IF;
+END;
+$$;
+CREATE UNIQUE INDEX IF NOT EXISTS tenants_prop_id_key ON tenants (prop_id);
+
 CREATE TABLE IF NOT EXISTS documents (
-    doc_id SERIAL UNIQUE NOT NULL,
     subject VARCHAR(200),
     recipient VARCHAR(60) NOT NULL REFERENCES tenants(email) ON DELETE CASCADE ON UPDATE CASCADE,
     date_sent TIMESTAMP,
+    date_retrieved TIMESTAMP,
     attachments VARCHAR(200),
     PRIMARY KEY(date_sent)
     );
 
-CREATE VIEW prop_tenant_view AS (
+-- time of the latest email retrieved by mailbox and recipient
+CREATE TABLE IF NOT EXISTS mail_sync_state (
+    mailbox VARCHAR(60) NOT NULL,
+    recipient VARCHAR(60) NOT NULL,
+    last_sent TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY(mailbox, recipient)
+    );
+
+CREATE OR REPLACE VIEW prop_tenant_view AS (
     SELECT pr.prop_id AS "Property ID",
            pr.ll_id AS "Landlord ID",
+           pr.num_prop_building AS "Number properties in building",
            pr.flat_num AS "Flat number",
            pr.street AS "Street",
            pr.post_code AS "Post code",
@@ -49,16 +81,16 @@ CREATE VIEW prop_tenant_view AS (
             ON pr.prop_id = tn.prop_id
             );
 
-CREATE VIEW doc_tenant_view AS (
-    SELECT dc.doc_id AS "Document ID",
-           tn.prop_id AS "Property ID",
+CREATE OR REPLACE VIEW doc_tenant_view AS (
+    SELECT tn.prop_id AS "Property ID",
            tn.first_name AS "First name",
            tn.last_name AS "Last name",
-           dc.subject AS "Subject",
            dc.recipient AS "Recipient",
+           dc.subject AS "Subject",
            dc.date_sent AS "Date sent",
+           dc.date_retrieved AS "Date retrieved",
            dc.attachments AS "Attachments"
     FROM documents AS dc
         JOIN tenants AS tn
-        ON dc.recipient = tn.email
-        );
+            ON dc.recipient = tn.email
+            );
@@ -0,0 +1,13 @@
+-- indexes on the record list filter and sort columns
+CREATE INDEX IF NOT EXISTS properties_ll_id_idx ON properties (ll_id);
+CREATE INDEX IF NOT EXISTS properties_street_idx ON properties (street);
+
+-- documents were keyed by date_sent alone, dropping an email sent to
+-- several tenants at once; (recipient, date_sent) is now the natural key
+ALTER TABLE documents DROP CONSTRAINT IF EXISTS documents_pkey;
+ALTER TABLE documents ALTER COLUMN date_sent SET NOT NULL;
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS doc_id SERIAL PRIMARY KEY;
+CREATE UNIQUE INDEX IF NOT EXISTS documents_recipient_date_sent_key
+    ON documents (recipient, date_sent);
+
+ANALYZE properties, tenants, documents;
@@ -0,0 +1,122 @@
+-- statistics tables behind the charts, kept up to date by triggers:
+--   landlord_stats
+--   building_stats
+-- each write recomputes only the landlords and streets it touches, so
+-- reading the charts costs one row per landlord or street
+
+CREATE TABLE IF NOT EXISTS landlord_stats (
+    ll_id VARCHAR(6) NOT NULL,
+    properties INT NOT NULL,
+    PRIMARY KEY(ll_id)
+    );
+
+-- buildings are told apart by street, as in the occupancy chart
+CREATE TABLE IF NOT EXISTS building_stats (
+    street VARCHAR(60) NOT NULL,
+    properties INT NOT NULL,
+    occupied INT NOT NULL,
+    capacity INT NOT NULL,
+    PRIMARY KEY(street)
+    );
+
+-- recompute the rows of the given landlords; the advisory locks, taken
+-- in a fixed order, make concurrent writers on the same landlord wait
+-- for each other so that the last one counts the rows of both (keys are
+-- hashed into 64 locks, a bulk import can't exhaust the lock table)
+CREATE OR REPLACE FUNCTION refresh_landlord_stats(landlords VARCHAR[]) RETURNS void AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('landlord_stats'), lock)
+        FROM (SELECT DISTINCT hashtext(unnest(landlords)) % 64 AS lock ORDER BY 1) AS locked;
+    DELETE FROM landlord_stats WHERE ll_id = ANY(landlords);
+    INSERT INTO landlord_stats (ll_id, properties)
+        SELECT ll_id, COUNT(*) FROM properties
+        WHERE ll_id = ANY(landlords)
+        GROUP BY ll_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- recompute the rows of the given streets, occupied counting the
+-- properties that have a tenant
+CREATE OR REPLACE FUNCTION refresh_building_stats(streets VARCHAR[]) RETURNS void AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('building_stats'), lock)
+        FROM (SELECT DISTINCT hashtext(unnest(streets)) % 64 AS lock ORDER BY 1) AS locked;
+    DELETE FROM building_stats WHERE street = ANY(streets);
+    INSERT INTO building_stats (street, properties, occupied, capacity)
+        SELECT pr.street, COUNT(*), COUNT(tn.prop_id), MIN(pr.num_prop_building)
+        FROM properties AS pr
+            LEFT JOIN tenants AS tn
+                ON pr.prop_id = tn.prop_id
+        WHERE pr.street = ANY(streets)
+        GROUP BY pr.street;
+END;
+$$ LANGUAGE plpgsql;
+
+-- statement triggers, one per event since transition tables can't be
+-- shared between events; new_rows or old_rows is only read for the
+-- events that define it
+CREATE OR REPLACE FUNCTION properties_stats_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_landlord_stats(ARRAY(SELECT ll_id FROM new_rows)),
+                refresh_building_stats(ARRAY(SELECT street FROM new_rows));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_landlord_stats(ARRAY(SELECT ll_id FROM old_rows)),
+                refresh_building_stats(ARRAY(SELECT street FROM old_rows));
+    ELSE
+        PERFORM refresh_landlord_stats(ARRAY(SELECT ll_id FROM new_rows
+                                             UNION SELECT ll_id FROM old_rows)),
+                refresh_building_stats(ARRAY(SELECT street FROM new_rows
+                                             UNION SELECT street FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tenants_stats_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_building_stats(ARRAY(
+            SELECT pr.street FROM new_rows JOIN properties AS pr USING (prop_id)));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_building_stats(ARRAY(
+            SELECT pr.street FROM old_rows JOIN properties AS pr USING (prop_id)));
+    ELSE
+        PERFORM refresh_building_stats(ARRAY(
+            SELECT pr.street FROM (SELECT prop_id FROM new_rows
+                                   UNION SELECT prop_id FROM old_rows) AS changed
+                JOIN properties AS pr USING (prop_id)));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER properties_stats_insert AFTER INSERT ON properties
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION properties_stats_trigger();
+CREATE TRIGGER properties_stats_update AFTER UPDATE ON properties
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION properties_stats_trigger();
+CREATE TRIGGER properties_stats_delete AFTER DELETE ON properties
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION properties_stats_trigger();
+
+CREATE TRIGGER tenants_stats_insert AFTER INSERT ON tenants
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tenants_stats_trigger();
+CREATE TRIGGER tenants_stats_update AFTER UPDATE ON tenants
+    REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tenants_stats_trigger();
+CREATE TRIGGER tenants_stats_delete AFTER DELETE ON tenants
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tenants_stats_trigger();
+
+-- statistics of the rows already there
+INSERT INTO landlord_stats (ll_id, properties)
+    SELECT ll_id, COUNT(*) FROM properties GROUP BY ll_id;
+INSERT INTO building_stats (street, properties, occupied, capacity)
+    SELECT pr.street, COUNT(*), COUNT(tn.prop_id), MIN(pr.num_prop_building)
+    FROM properties AS pr
+        LEFT JOIN tenants AS tn
+            ON pr.prop_id = tn.prop_id
+    GROUP BY pr.street;
@@ -0,0 +1,48 @@
+-- attachments of the sent emails, one row each, instead of the
+-- documents.attachments column holding the list of names as an array
+-- literal in a VARCHAR(200)
+
+CREATE TABLE IF NOT EXISTS document_attachments (
+    doc_id INT NOT NULL REFERENCES documents(doc_id) ON DELETE CASCADE,
+    -- order of the attachment in the email, from 1
+    position INT NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    size INT,
+    content_type VARCHAR(100),
+    PRIMARY KEY(doc_id, position)
+    );
+
+-- emails with an attachment of a given name
+CREATE INDEX IF NOT EXISTS document_attachments_name_idx ON document_attachments (name);
+
+INSERT INTO document_attachments (doc_id, position, name)
+    SELECT dc.doc_id, at.position, at.name
+    FROM documents AS dc,
+        unnest(dc.attachments::VARCHAR[]) WITH ORDINALITY AS at(name, position)
+    WHERE dc.attachments IS NOT NULL;
+
+-- one row per attachment, or a single row without attachment
+DROP VIEW doc_tenant_view;
+ALTER TABLE documents DROP COLUMN attachments;
+
+CREATE VIEW doc_tenant_view AS (
+    SELECT tn.prop_id AS "Property ID",
+           tn.first_name AS "First name",
+           tn.last_name AS "Last name",
+           dc.recipient AS "Recipient",
+           dc.subject AS "Subject",
+           dc.date_sent AS "Date sent",
+           dc.date_retrieved AS "Date retrieved",
+           dc.doc_id AS "Document ID",
+           at.position AS "Attachment number",
+           at.name AS "Attachment",
+           at.size AS "Attachment size",
+           at.content_type AS "Content type"
+    FROM documents AS dc
+        JOIN tenants AS tn
+            ON dc.recipient = tn.email
+        LEFT JOIN document_attachments AS at
+            ON dc.doc_id = at.doc_id
+            );
+
+ANALYZE document_attachments;
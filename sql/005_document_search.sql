@@ -0,0 +1,20 @@
+-- full-text search over the email subjects, the vector is computed by
+-- the server whenever a subject is inserted or changed
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('english', COALESCE(subject, ''))) STORED;
+CREATE INDEX IF NOT EXISTS documents_search_idx ON documents USING GIN (search_vector);
+
+-- attachment names are matched as substrings, which a trigram index
+-- speeds up; pg_trgm ships with the contrib modules, without them the
+-- names are still searched, by a sequential scan
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS document_attachments_name_trgm_idx
+            ON document_attachments USING GIN (name gin_trgm_ops);
+    END IF;
+END;
+$$;
+
+ANALYZE documents;
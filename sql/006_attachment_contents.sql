@@ -0,0 +1,25 @@
+-- SHA-256 digest of the attachment content kept in the local attachment
+-- store, NULL when it wasn't downloaded
+ALTER TABLE document_attachments ADD COLUMN IF NOT EXISTS sha256 CHAR(64);
+CREATE INDEX IF NOT EXISTS document_attachments_sha256_idx ON document_attachments (sha256);
+
+CREATE OR REPLACE VIEW doc_tenant_view AS (
+    SELECT tn.prop_id AS "Property ID",
+           tn.first_name AS "First name",
+           tn.last_name AS "Last name",
+           dc.recipient AS "Recipient",
+           dc.subject AS "Subject",
+           dc.date_sent AS "Date sent",
+           dc.date_retrieved AS "Date retrieved",
+           dc.doc_id AS "Document ID",
+           at.position AS "Attachment number",
+           at.name AS "Attachment",
+           at.size AS "Attachment size",
+           at.content_type AS "Content type",
+           at.sha256 AS "Content SHA-256"
+    FROM documents AS dc
+        JOIN tenants AS tn
+            ON dc.recipient = tn.email
+        LEFT JOIN document_attachments AS at
+            ON dc.doc_id = at.doc_id
+            );
@@ -0,0 +1,40 @@
+'''Fixtures shared by the tests
+
+The database tests run against the scratch PostgreSQL database named by
+the CRM_TEST_DATABASE environment variable, whose tables they drop and
+recreate, and are skipped when it is not set:
+
+    CRM_TEST_DATABASE=crm_test CRM_TEST_USER=crm CRM_TEST_PASSWORD=secret python -m pytest
+'''
+
+import os
+import pytest
+from benchmarks.fake_graph import FakeGraphServer, SyntheticMailbox
+from benchmarks.indexes import drop_command
+from crm_app.models import SQLModel
+
+
+@pytest.fixture
+def model():
+    database = os.environ.get('CRM_TEST_DATABASE')
+    if not database:
+        pytest.skip('CRM_TEST_DATABASE is not set')
+    model = SQLModel(os.environ.get('CRM_TEST_HOST', 'localhost'), database,
+                     os.environ.get('CRM_TEST_USER', 'crm'),
+                     os.environ.get('CRM_TEST_PASSWORD', ''))
+    model.query(drop_command)
+    model.create_db_and_tables()
+    yield model
+    model.query(drop_command)
+    model.close()
+
+
+@pytest.fixture(scope='module')
+def mailbox():
+    return SyntheticMailbox(messages=300, recipients=20, attachment_size=2000)
+
+
+@pytest.fixture
+def server(mailbox):
+    with FakeGraphServer(mailbox) as server:
+        yield server
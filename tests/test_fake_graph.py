@@ -0,0 +1,26 @@
+from benchmarks.fake_graph import FakeGraphServer, SyntheticMailbox, offline_session
+from crm_app.network import RetrieveSentDocuments
+
+
+def test_mailbox_repeatable():
+    first = SyntheticMailbox(messages=50, recipients=5)
+    second = SyntheticMailbox(messages=50, recipients=5)
+    assert first.messages == second.messages
+    attachment = next(attachment for message in first.messages
+                      for attachment in message['attachments'])
+    assert len(first.content(attachment['id'])) == attachment['size']
+
+
+def test_added_messages_listed():
+    mailbox = SyntheticMailbox(messages=150, recipients=5)
+    with FakeGraphServer(mailbox) as server:
+        session = offline_session(server, requests_delay=0)
+        sent_docs = RetrieveSentDocuments(session, concurrency=1)
+        sent_docs.get_all(mailbox.tenant_emails)
+        assert sent_docs.scanned == 150
+        mailbox.add(10)
+        again = RetrieveSentDocuments(session, concurrency=1)
+        again.get_all(mailbox.tenant_emails, since=sent_docs.last_sent)
+        # the newest message of the first retrieval, sent at since, and the new ones
+        assert again.scanned == 11
+        assert server.requests > 0 and server.bytes_sent > 0
@@ -0,0 +1,279 @@
+import csv
+import hashlib
+import io
+import os
+from datetime import datetime
+from benchmarks.indexes import fill_commands
+from crm_app.models import AttachmentStore, CSVModel
+
+
+def records_csv(rows):
+    fh = io.StringIO()
+    writer = csv.DictWriter(fh, fieldnames=list(CSVModel.fields))
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    fh.seek(0)
+    return fh
+
+
+def record(prop_id, email='', **values):
+    row = {'Property ID': prop_id, 'Landlord ID': 'L1', 'Number properties in building': '10',
+           'Flat number': '1', 'Street': 'High Street', 'Post code': 'NW1', 'City': 'London',
+           'First name': 'First' if email else '', 'Last name': 'Last' if email else '',
+           'Email': email}
+    row.update(values)
+    return row
+
+
+def test_import_rejects(model):
+    results = model.import_records(records_csv([
+        record('P2', 'two@example.com'),
+        record('', 'three@example.com'),
+        record('P3', 'four@example.com', **{'Number properties in building': 'ten'}),
+        # the later row of a duplicate email is kept
+        record('P4', 'five@example.com'),
+        record('P5', 'five@example.com'),
+        record('P7'),
+    ]), list(CSVModel.fields))
+    assert results['rows'] == 6
+    assert results['imported'] == 3
+    # line numbers in the file, counting the header line
+    assert results['rejects'] == [(3, 'missing Property ID'),
+                                  (4, 'invalid Number properties in building'),
+                                  (5, 'duplicate Email')]
+    tenants = model.query('SELECT prop_id, email FROM tenants ORDER BY prop_id')
+    assert [tuple(row) for row in tenants] == [('P2', 'two@example.com'),
+                                               ('P5', 'five@example.com')]
+    assert model.get_record('P7')['Email'] is None
+
+
+def test_import_rejects_email_of_another_tenant(model):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    results = model.import_records(records_csv([record('P2', 'two@example.com'),
+                                                record('P6', 'one@example.com')]),
+                                   list(CSVModel.fields))
+    assert results['rejects'] == [(3, 'Email of the tenant of another property')]
+    assert model.get_record('P6') == {}
+
+
+def test_add_tenants(model):
+    model.import_records(records_csv([record('P1', 'one@example.com'), record('P2')]),
+                         list(CSVModel.fields))
+    tenant = {'First name': 'New', 'Last name': 'Tenant'}
+    # the last record of a property wins
+    results = model.add_tenants([dict(tenant, **{'Property ID': 'P1', 'Email': 'x@example.com'}),
+                                 dict(tenant, **{'Property ID': 'P1', 'Email': 'new@example.com'}),
+                                 dict(tenant, **{'Property ID': 'P2', 'Email': 'two@example.com'})])
+    assert results == {'P1': 'update tenant', 'P2': 'insert tenant'}
+    assert model.get_record('P1')['Email'] == 'new@example.com'
+    assert model.get_record('P2')['First name'] == 'New'
+
+
+def all_pages(model, limit, **query):
+    '''Records of all the pages, each starting after the last record of the previous'''
+
+    column = query.get('sort_column', 'Property ID')
+    records = []
+    after = None
+    while True:
+        page = model.get_records_page(**query, after=after, limit=limit)
+        records.extend(page)
+        if len(page) < limit:
+            return records
+        last = page[-1]
+        after = ('' if last[column] is None else last[column], last['Property ID'])
+
+
+def test_records_pages(model):
+    for command in fill_commands[:3]:
+        model.query(command, {'size': 500})
+    for query in [{}, {'sort_column': 'Street', 'descending': True},
+                  {'sort_column': 'Email'},
+                  {'sort_column': 'Flat number', 'filters': {'Street': 'street 1', 'Tenant': True}}]:
+        everything = model.get_records_page(**query, limit=1000)
+        assert everything
+        assert all_pages(model, 37, **query) == everything
+
+
+def test_records_filters(model):
+    for command in fill_commands[:3]:
+        model.query(command, {'size': 500})
+    vacant = model.get_records_page(filters={'Tenant': False}, limit=1000)
+    assert len(vacant) == 100
+    assert all(row['Email'] is None for row in vacant)
+    # LIKE wildcards typed in the filter match themselves only
+    assert model.get_records_page(filters={'Email': 't1%'}, limit=1000) == []
+
+
+def sent_emails():
+    return [{'Subject': 'Lease', 'Recipient': 'one@example.com',
+             'Date sent': '2023-06-01 12:00:00+01:00',
+             'Attachments': [{'name': 'lease.pdf', 'size': 10,
+                              'content_type': 'application/pdf', 'sha256': None},
+                             {'name': None, 'size': 5, 'content_type': None, 'sha256': None}]},
+            {'Subject': 'Notice', 'Recipient': 'one@example.com',
+             'Date sent': '2023-06-02 12:00:00+01:00', 'Attachments': None}]
+
+
+def test_document_attachments(model):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    assert model.insert_retrieved_documents(sent_emails()) == 2
+    # one row per attachment, unnamed ones with an empty name
+    rows = model.get_documents_by_email('one@example.com', attachments=False)
+    assert [(row['Subject'], row['Attachment number'], row['Attachment']) for row in rows] == [
+        ('Lease', 1, 'lease.pdf'), ('Lease', 2, ''), ('Notice', None, None)]
+    rows = model.get_documents_by_email('one@example.com', attachments=True)
+    assert [row['Attachment'] for row in rows] == ['lease.pdf', '']
+
+
+def test_attachment_digests(model):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    emails = sent_emails()
+    digest = 'a' * 64
+    emails[0]['Attachments'][0]['sha256'] = digest
+    model.insert_retrieved_documents(emails)
+    # the time as sent, without its offset
+    assert model.get_attachment_digests(['one@example.com']) == {
+        ('one@example.com', datetime(2023, 6, 1, 12), 1): digest}
+    # a retrieval without the store keeps the digest
+    model.insert_retrieved_documents(sent_emails())
+    assert model.get_attachment_digests(['one@example.com']) != {}
+    # only the documents an incremental retrieval can see again
+    assert model.get_attachment_digests(['one@example.com'],
+                                        since=datetime(2023, 6, 1, 12)) != {}
+    assert model.get_attachment_digests(['one@example.com'],
+                                        since=datetime(2023, 6, 1, 12, 1)) == {}
+
+
+def test_attachment_store(tmp_path):
+    store = AttachmentStore(tmp_path)
+    content = b'lease ' * 50000
+    digest = store.put(content[start:start + 1000] for start in range(0, len(content), 1000))
+    assert digest == hashlib.sha256(content).hexdigest()
+    assert digest in store
+    # the same content is stored once
+    assert store.put([content]) == digest
+    assert os.listdir(store.tmp_path) == []
+    with store.open(digest) as stored:
+        assert stored[:6] == b'lease ' and len(stored) == len(content)
+        assert bytes(stored) == content
+
+    empty = store.put([])
+    with store.open(empty) as stored:
+        assert stored == b''
+
+
+def test_retrieved_documents_pruned(model, monkeypatch):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    # several statements, an email listed twice saved once
+    monkeypatch.setattr(model, 'documents_batch_size', 1)
+    emails = sent_emails()
+    assert model.insert_retrieved_documents(emails + emails[:1]) == 2
+
+    # a complete retrieval, a day later, removes the documents no longer on the server
+    model.query('UPDATE documents SET date_retrieved = date_retrieved - INTERVAL \'1 day\'')
+    model.insert_retrieved_documents(emails[:1], recipients=['one@example.com'])
+    subjects = model.query('SELECT subject FROM documents')
+    assert [row['subject'] for row in subjects] == ['Lease']
+    assert model.query('SELECT COUNT(*) FROM document_attachments')[0][0] == 2
+
+
+def assert_statistics(model):
+    '''The trigger-maintained statistics match the base tables'''
+
+    landlords = model.query('SELECT ll_id, COUNT(*) FROM properties GROUP BY ll_id ORDER BY 1')
+    assert model.query('SELECT ll_id, properties FROM landlord_stats ORDER BY 1') == landlords
+    buildings = model.query('SELECT pr.street, COUNT(*), COUNT(tn.prop_id), '
+                            'MIN(pr.num_prop_building) FROM properties AS pr '
+                            'LEFT JOIN tenants AS tn USING (prop_id) GROUP BY pr.street ORDER BY 1')
+    assert model.query('SELECT street, properties, occupied, capacity FROM building_stats '
+                       'ORDER BY 1') == buildings
+
+
+def test_statistics(model):
+    model.import_records(records_csv([
+        record('P1', 'one@example.com'), record('P2', 'two@example.com'),
+        record('P3', **{'Landlord ID': 'L2'}), record('P4', 'four@example.com', Street='Low Road'),
+    ]), list(CSVModel.fields))
+    assert_statistics(model)
+    assert len(model.query('SELECT * FROM building_stats')) == 2
+
+    tenant = {'First name': 'New', 'Last name': 'Tenant'}
+    model.add_tenants([dict(tenant, **{'Property ID': 'P3', 'Email': 'three@example.com'}),
+                       dict(tenant, **{'Property ID': 'P1', 'Email': 'new@example.com'})])
+    assert_statistics(model)
+    model.query('DELETE FROM tenants WHERE prop_id = %(prop_id)s', {'prop_id': 'P2'})
+    assert_statistics(model)
+
+    # the tenant goes with the property
+    model.delete_property({'Property ID': 'P1'})
+    assert_statistics(model)
+    assert model.query('SELECT * FROM tenants WHERE prop_id = \'P1\'') == []
+
+    # the last property of Low Road moves to High Street
+    model.import_records(records_csv([record('P4', 'four@example.com')]), list(CSVModel.fields))
+    assert_statistics(model)
+    assert [row['street'] for row in model.query('SELECT street FROM building_stats')] == [
+        'High Street']
+
+
+def search_emails():
+    def email(subject, day, *names):
+        return {'Subject': subject, 'Recipient': 'one@example.com',
+                'Date sent': f'2023-06-{day:02} 12:00:00+00:00',
+                'Attachments': [{'name': name, 'size': 1, 'content_type': None, 'sha256': None}
+                                for name in names] or None}
+
+    return [email('Security deposit return', 1, 'deposit_receipt.pdf', 'lease.pdf'),
+            email('Deposit reminder', 2),
+            email('Inventory', 3, 'deposit.pdf'),
+            email('Rent statement', 4, '100%_paid.pdf'),
+            email('Rent statement', 5, '100x_paid.pdf')]
+
+
+def documents(rows):
+    '''Subjects and ids of the documents of search results, in order'''
+
+    found = []
+    for row in rows:
+        if not found or found[-1][1] != row['Document ID']:
+            found.append((row['Subject'], row['Document ID']))
+    return found
+
+
+def test_search_documents(model):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    model.insert_retrieved_documents(search_emails())
+
+    rows = model.search_documents('deposit')
+    # the subject and an attachment name matching first, one row per attachment
+    assert [subject for subject, _ in documents(rows)] == [
+        'Security deposit return', 'Inventory', 'Deposit reminder']
+    assert [row['Attachment'] for row in rows[:2]] == ['deposit_receipt.pdf', 'lease.pdf']
+    assert rows[0]['Rank'] > rows[2]['Rank'] > rows[3]['Rank']
+
+    # wildcards typed in the search match themselves only
+    assert [row['Attachment'] for row in model.search_documents('100%')] == ['100%_paid.pdf']
+    assert documents(model.search_documents('deposit', date_range=(None, '2023-06-02'))) == [
+        documents(rows)[0], documents(rows)[2]]
+    assert model.search_documents('deposit', recipient='two@example.com') == []
+    assert model.search_documents('  ') == []
+
+
+def test_search_documents_pages(model):
+    model.import_records(records_csv([record('P1', 'one@example.com')]), list(CSVModel.fields))
+    model.insert_retrieved_documents(search_emails())
+    # ranks of different documents, and the same rank, told apart by Document ID
+    for query in ['deposit', 'rent']:
+        everything = model.search_documents(query)
+        pages = []
+        after = None
+        while True:
+            page = model.search_documents(query, after=after, limit=1)
+            if not page:
+                break
+            assert len(documents(page)) == 1
+            pages.extend(page)
+            after = (page[-1]['Rank'], page[-1]['Document ID'])
+        assert pages == everything
@@ -0,0 +1,271 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from O365.utils import Recipient
+from benchmarks.fake_graph import FakeGraphServer, offline_session
+from benchmarks.sync import fill_commands
+from crm_app import network as n
+from crm_app.application import Application
+from crm_app.models import AttachmentStore
+
+
+def expected_emails(mailbox, tenant_emails):
+    '''(recipient, subject) of the emails to the tenants, in server order'''
+
+    tenants = {email.lower(): email for email in tenant_emails}
+    return [(tenants[to['emailAddress']['address'].lower()], message['subject'])
+            for message in mailbox.messages for to in message['toRecipients']
+            if to['emailAddress']['address'].lower() in tenants]
+
+
+def retrieved_emails(sent_docs):
+    return [(email['Recipient'], email['Subject']) for email in sent_docs.emails]
+
+
+def sent_time(message):
+    return datetime.fromisoformat(message['sentDateTime'].replace('Z', '+00:00'))
+
+
+def test_query_params():
+    since = datetime(2023, 6, 1, 12, 30, tzinfo=timezone(timedelta(hours=2)))
+    params = n.SentMessagesQuery(recipient="o'brien@example.com", since=since).as_params()
+    assert params['$expand'] == n.SentMessagesQuery.expand
+    assert params['$filter'] == ("toRecipients/any(r:r/emailAddress/address eq "
+                                 "'o''brien@example.com') and "
+                                 "sentDateTime ge 2023-06-01T10:30:00Z")
+
+
+def test_query_params_without_filter():
+    assert n.SentMessagesQuery().as_params() == {'$expand': n.SentMessagesQuery.expand}
+
+
+def test_query_params_window():
+    query = n.SentMessagesQuery(since=datetime(2023, 6, 1, tzinfo=timezone.utc),
+                                until=datetime(2023, 7, 1, tzinfo=timezone.utc))
+    assert query.as_params()['$filter'] == ('sentDateTime ge 2023-06-01T00:00:00Z and '
+                                            'sentDateTime lt 2023-07-01T00:00:00Z')
+
+
+@pytest.mark.parametrize('recipient, address', [
+    (Recipient(address='Tenant1@Example.com', name='Tenant One'), 'tenant1@example.com'),
+    (Recipient(address='', name='No Address'), None),
+    ('Tenant One <Tenant1@example.com>', 'tenant1@example.com'),
+    ('Tenant One (tenant1@example.com)', 'tenant1@example.com'),
+    ('tenant1@example.com', 'tenant1@example.com'),
+    ('Tenant One', None),
+])
+def test_recipient_address(recipient, address):
+    assert n.recipient_address(recipient) == address
+
+
+def test_get_one_tenant(mailbox, server):
+    tenant = mailbox.tenant_emails[3]
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+    sent_docs.get(tenant_email=tenant)
+    assert retrieved_emails(sent_docs) == expected_emails(mailbox, [tenant])
+    # filtered by the server
+    assert sent_docs.scanned < len(mailbox.messages)
+
+
+def test_get_since(mailbox, server):
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+    sent_docs.get_all(mailbox.tenant_emails, since=sent_time(mailbox.messages[49]))
+    assert sent_docs.scanned == 50
+    assert sent_docs.last_sent == sent_time(mailbox.messages[0])
+
+
+def test_get_all(mailbox, server):
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+    requests = server.requests
+    sent_docs.get_all(mailbox.tenant_emails)
+    assert retrieved_emails(sent_docs) == expected_emails(mailbox, mailbox.tenant_emails)
+    assert sent_docs.scanned == len(mailbox.messages)
+    assert not sent_docs.cancelled
+    # one pass over the folder for all the tenants
+    assert server.requests - requests <= -(-len(mailbox.messages) // sent_docs.batch_size) + 2
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_get_all_windows(mailbox, server, concurrency):
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0),
+                                        concurrency=concurrency)
+    # a window a day or less, several for the fixture's two days of emails
+    sent_docs.min_window = timedelta(hours=6)
+    sent_docs.get_all(mailbox.tenant_emails)
+    # in server order, as by one request
+    assert retrieved_emails(sent_docs) == expected_emails(mailbox, mailbox.tenant_emails)
+    assert sent_docs.last_sent == sent_time(mailbox.messages[0])
+
+
+def test_throttled_requests_are_retried(mailbox):
+    with FakeGraphServer(mailbox, throttle_every=3) as server:
+        sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+        sent_docs.get_all(mailbox.tenant_emails)
+        assert server.throttled > 0
+    assert retrieved_emails(sent_docs) == expected_emails(mailbox, mailbox.tenant_emails)
+
+
+def test_throttled_downloads_are_retried(mailbox, tmp_path):
+    with FakeGraphServer(mailbox, throttle_every=3) as server:
+        sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0),
+                                            store=AttachmentStore(tmp_path))
+        sent_docs.get_all(mailbox.tenant_emails)
+        assert server.throttled > 0
+    digests = [attachment['sha256'] for email in sent_docs.emails
+               for attachment in email['Attachments'] or []]
+    assert digests and all(digests)
+
+
+def test_sync(model, mailbox, server, tmp_path):
+    for command in fill_commands:
+        model.query(command, {'size': len(mailbox.tenant_emails)})
+    session = offline_session(server, requests_delay=0)
+    store = AttachmentStore(tmp_path)
+    sent_docs = n.RetrieveSentDocuments(session, store=store)
+    inserted = sent_docs.sync(model, mailbox.tenant_emails)
+    # a document per recipient and sending time
+    saved = {(email['Recipient'], email['Date sent']) for email in sent_docs.emails}
+    assert inserted == len(saved)
+    assert retrieved_emails(sent_docs) == expected_emails(mailbox, mailbox.tenant_emails)
+    assert model.get_last_sent(session.account_email, mailbox.tenant_emails) == \
+        sent_time(mailbox.messages[0])
+
+    # the next sync starts from the newest email saved, its attachments stored
+    again = n.RetrieveSentDocuments(session, store=store)
+    again.sync(model, mailbox.tenant_emails)
+    assert again.emails and retrieved_emails(again) == \
+        retrieved_emails(sent_docs)[:len(again.emails)]
+    assert again.scanned < len(mailbox.messages)
+    assert len(again.stored) >= sum(len(email['Attachments'] or []) for email in again.emails)
+    assert model.query('SELECT COUNT(*) FROM documents')[0][0] == len(saved)
+
+
+def test_progress(mailbox, server):
+    progress = []
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+    sent_docs.get_all(mailbox.tenant_emails,
+                      progress=lambda scanned, matched: progress.append((scanned, matched)))
+    assert progress[-1] == (len(mailbox.messages), len(sent_docs.emails))
+
+
+def test_cancelled(mailbox, server):
+    cancel = threading.Event()
+    cancel.set()
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0))
+    sent_docs.get_all(mailbox.tenant_emails, cancel=cancel)
+    assert sent_docs.cancelled
+    assert sent_docs.emails == []
+
+
+def test_attachments_stored(mailbox, server, tmp_path):
+    store = AttachmentStore(tmp_path)
+    sent_docs = n.RetrieveSentDocuments(offline_session(server, requests_delay=0),
+                                        store=store)
+    sent_docs.get_all(mailbox.tenant_emails)
+    records = [attachment for email in sent_docs.emails for attachment in email['Attachments'] or []]
+    assert records
+    for attachment in records:
+        with store.open(attachment['sha256']) as content:
+            assert hashlib.sha256(content).hexdigest() == attachment['sha256']
+
+    # contents saved by the first retrieval aren't downloaded again
+    stored = {(email['Recipient'], sent_docs.saved_time(datetime.fromisoformat(email['Date sent'])),
+               position): attachment['sha256']
+              for email in sent_docs.emails
+              for position, attachment in enumerate(email['Attachments'] or [], 1)}
+    again = n.RetrieveSentDocuments(offline_session(server, requests_delay=0), store=store,
+                                    concurrency=1)
+    again.stored = stored
+    requests = server.requests
+    again.get_all(mailbox.tenant_emails)
+    assert again.emails == sent_docs.emails
+    # the listing pages only
+    assert server.requests - requests == -(-len(mailbox.messages) // again.batch_size)
+
+
+class FakeAccount():
+    '''O365 Account whose token expires at expiry, counting the refreshes'''
+
+    def __init__(self, credentials, token_backend=None, protocol=None, requests_delay=200):
+        self.credentials = credentials
+        self.requests_delay = requests_delay
+        self.is_authenticated = True
+        self.refreshes = 0
+        self.expiry = datetime.now(timezone.utc) + timedelta(hours=1)
+        self.con = SimpleNamespace(
+            session=SimpleNamespace(headers={'Authorization': 'Bearer 0'}),
+            token_backend=SimpleNamespace(token_expiration_datetime=lambda: self.expiry),
+            refresh_token=self.refresh_token)
+
+    def refresh_token(self):
+        self.refreshes += 1
+        # slow enough for the other threads to be waiting
+        time.sleep(0.05)
+        self.con.session.headers['Authorization'] = f'Bearer {self.refreshes}'
+        self.expiry = datetime.now(timezone.utc) + timedelta(hours=1)
+        return True
+
+    def mailbox(self, resource):
+        return SimpleNamespace(sent_folder=lambda: SimpleNamespace())
+
+
+def settings(account_email='landlord@example.com'):
+    values = {'account_email': account_email, 'client_id': 'id', 'client_secret': 'secret'}
+    return {key: SimpleNamespace(get=lambda value=value: value) for key, value in values.items()}
+
+
+@pytest.fixture
+def fake_account(monkeypatch):
+    monkeypatch.setattr(n, 'Account', FakeAccount)
+    monkeypatch.setattr(n, 'FileSystemTokenBackend', lambda **kwargs: None)
+    monkeypatch.setattr(n, 'MSGraphProtocol', lambda **kwargs: None)
+
+
+def test_token_moved_to_token_path(fake_account, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / n.MailSession.token_filename).write_text('token')
+    n.MailSession(settings(), token_path=tmp_path / 'config')
+    assert (tmp_path / 'config' / n.MailSession.token_filename).read_text() == 'token'
+    assert not (tmp_path / n.MailSession.token_filename).exists()
+
+
+def test_refresh_if_expiring(fake_account, tmp_path):
+    session = n.MailSession(settings(), token_path=tmp_path)
+    assert not session.refresh_if_expiring()
+    assert session.account.refreshes == 0
+    session.account.expiry = datetime.now(timezone.utc) + timedelta(minutes=2)
+    assert session.refresh_if_expiring()
+    assert session.account.refreshes == 1
+
+
+def test_concurrent_refresh_once(fake_account, tmp_path):
+    session = n.MailSession(settings(), token_path=tmp_path)
+    # as O365 does on an expired token, on every worker thread
+    threads = [threading.Thread(target=session.account.con.refresh_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.account.refreshes == 1
+    assert session.account.con.session.headers['Authorization'] == 'Bearer 1'
+
+
+def test_mail_session_reused(fake_account, tmp_path):
+    scheduled = []
+    app = SimpleNamespace(settings=settings(), mail_session=None, config_dir=tmp_path,
+                          token_check_interval=Application.token_check_interval,
+                          refresh_mail_token=None,
+                          after=lambda delay, callback: scheduled.append(callback))
+    session = Application.get_mail_session(app)
+    assert Application.get_mail_session(app) is session
+    # the server's throttling is waited out instead of pausing every request
+    assert session.account.requests_delay == 0
+    # a new session when the account settings change, the token check
+    # scheduled once
+    app.settings = settings('other@example.com')
+    other = Application.get_mail_session(app)
+    assert other is not session and other.account_email == 'other@example.com'
+    assert len(scheduled) == 1